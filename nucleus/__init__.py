@@ -1,6 +1,8 @@
 import logging
 import blinker
+import sqlite3
 
+from contextlib import contextmanager
 from web_ui import db, app
 
 from sqlalchemy.orm import sessionmaker
@@ -75,6 +77,161 @@ class VesicleStateError(Exception):
     pass
 
 
+def commit_session(session=None):
+    """Commit session or, inside of batch_transaction(), only flush it
+
+    Args:
+        session (Session): (Optional) session to commit instead of db.session
+    """
+    if session is None:
+        session = db.session
+
+    if session.info.get("batch_depth", 0) > 0:
+        session.flush()
+    else:
+        session.commit()
+
+
+def _begin_sqlite_batch(session):
+    """Begin the transaction of session on SQLite connections explicitly
+
+    pysqlite commits open transactions before emitting SAVEPOINT. Its
+    transaction handling is disabled for the connection of a batch, so that
+    savepoints work. See http://docs.sqlalchemy.org/en/rel_0_9/dialects/sqlite.html#pysqlite-serializable
+
+    Returns:
+        tuple: The DBAPI connection and its previous isolation level
+        None: If session is not connected to SQLite
+    """
+    connection = session.connection()
+    if connection.dialect.name != "sqlite":
+        return None
+
+    dbapi_connection = connection.connection.connection
+    isolation_level = dbapi_connection.isolation_level
+    dbapi_connection.isolation_level = None
+    connection.execute("BEGIN")
+    return (dbapi_connection, isolation_level)
+
+
+@contextmanager
+def batch_transaction(session=None):
+    """Apply all changes made inside the block in a single transaction
+
+    commit_session() only flushes while the block runs. The transaction is
+    committed when the outermost block is left and rolled back if it raises.
+    Changes pending before the outermost block are committed when it starts.
+
+    The transaction holds the SQLite write lock, which makes other greenlets
+    block when they write. Code inside the block must not yield to other
+    greenlets, e.g. by waiting for HTTP requests or the crypto_executor.
+    Such work can be deferred with after_commit().
+
+    Args:
+        session (Session): (Optional) session to use instead of db.session
+
+    Yields:
+        Session: The session used for the transaction
+    """
+    if session is None:
+        session = db.session
+
+    depth = session.info.get("batch_depth", 0)
+    sqlite_state = None
+    if depth == 0:
+        session.commit()
+        sqlite_state = _begin_sqlite_batch(session)
+
+    session.info["batch_depth"] = depth + 1
+    callbacks = list()
+    try:
+        yield session
+        if depth == 0:
+            session.commit()
+            callbacks = session.info.pop("after_commit", [])
+    except:
+        if depth == 0:
+            session.rollback()
+            session.info.pop("after_commit", None)
+        raise
+    finally:
+        session.info["batch_depth"] = depth
+        if sqlite_state is not None:
+            try:
+                sqlite_state[0].isolation_level = sqlite_state[1]
+            except sqlite3.Error:
+                # Connection has been closed
+                pass
+
+    for callback in callbacks:
+        try:
+            callback()
+        except Exception, e:
+            logger.error("Error running callback after commit: {}".format(e))
+
+
+def in_batch_transaction(session=None):
+    """Return True while the session is inside of batch_transaction()
+
+    Args:
+        session (Session): (Optional) session to use instead of db.session
+    """
+    if session is None:
+        session = db.session
+    return session.info.get("batch_depth", 0) > 0
+
+
+def after_commit(callback, session=None):
+    """Call callback once the changes made so far have been committed
+
+    Inside of batch_transaction() the callback runs after the outermost
+    block has committed. It is dropped if the transaction or the enclosing
+    savepoint() is rolled back. Outside of a batch transaction the callback
+    runs right away.
+
+    Args:
+        callback (function): Called without arguments
+        session (Session): (Optional) session to use instead of db.session
+    """
+    if session is None:
+        session = db.session
+
+    if in_batch_transaction(session):
+        session.info.setdefault("after_commit", list()).append(callback)
+    else:
+        callback()
+
+
+@contextmanager
+def savepoint(session=None):
+    """Inside of batch_transaction(), roll back only the changes of this block if it raises
+
+    Outside of a batch transaction the block runs without a savepoint.
+
+    Args:
+        session (Session): (Optional) session to use instead of db.session
+    """
+    if session is None:
+        session = db.session
+
+    if session.info.get("batch_depth", 0) == 0:
+        yield
+        return
+
+    transaction = session.begin_nested()
+    callback_count = len(session.info.get("after_commit", []))
+    try:
+        yield
+    except:
+        if transaction.is_active:
+            transaction.rollback()
+        del session.info.get("after_commit", [])[callback_count:]
+        raise
+    else:
+        if transaction.is_active:
+            transaction.commit()
+
+
 # Import at bottom to avoid circular imports
 # Import all models to allow querying db binds
 from nucleus.models import *
@@ -96,3 +253,4 @@ def create_session():
 
     # db.session is managed by Flask-SQLAlchemy and bound to a request
     return db.session
+
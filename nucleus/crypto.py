@@ -0,0 +1,405 @@
+import json
+import os
+import sys
+import time
+
+from collections import OrderedDict
+from gevent import spawn
+from hashlib import sha256
+from keyczar.errors import KeyczarError
+from keyczar.keys import AesKey, HmacKey, RsaPrivateKey, RsaPublicKey
+
+from web_ui import app
+
+
+class LRUCache(object):
+    """Bounded mapping that evicts its least recently used entries
+
+    Entry keys are tuples whose first element is the ID of the Identity or
+    Souma the entry belongs to, so that all entries of an owner can be removed
+    at once.
+
+    Args:
+        maxsize (int): Maximum number of entries kept in memory
+    """
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """Return the value stored for key and mark it as recently used
+
+        Returns:
+            object: Stored value or None if key is not in the cache
+        """
+        try:
+            value = self._entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self._entries[key] = value
+        return value
+
+    def put(self, key, value):
+        """Store value for key, evicting the least recently used entry if neccessary"""
+        if key in self._entries:
+            self._discard(self._entries.pop(key))
+        elif len(self._entries) >= self.maxsize:
+            self._discard(self._entries.popitem(last=False)[1])
+        self._entries[key] = value
+
+    def _discard(self, value):
+        """Called with every value that is removed from the cache"""
+        pass
+
+    def invalidate(self, owner_id):
+        """Remove all entries of an owner
+
+        Args:
+            owner_id (String): ID of the Identity or Souma whose entries are removed
+        """
+        for key in [k for k in self._entries if k[0] == owner_id]:
+            self._discard(self._entries.pop(key))
+
+    def clear(self):
+        """Remove all entries and reset statistics"""
+        for value in self._entries.values():
+            self._discard(value)
+        self._entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        """Return usage statistics of this cache
+
+        Returns:
+            dict: Keys `size`, `maxsize`, `hits` and `misses`
+        """
+        return {
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses
+        }
+
+
+class KeyCache(LRUCache):
+    """Cache of parsed KeyCzar RSA keys
+
+    Keys are stored JSON encoded on Identity and Souma objects and parsing them
+    is about as expensive as using them. Parsed key objects are cached by
+    owner id and key fingerprint, so a replaced key can never hit a stale entry.
+    """
+
+    def _get(self, key_cls, owner_id, key_json):
+        """Return a parsed key, reading it with key_cls if it is not cached
+
+        Args:
+            key_cls (class): RsaPublicKey or RsaPrivateKey
+            owner_id (String): ID of the Identity or Souma owning the key
+            key_json (String): JSON encoded KeyCzar key
+
+        Returns:
+            RsaPublicKey or RsaPrivateKey: The parsed key
+        """
+        # Leave error reporting for missing keys to KeyCzar
+        if not key_json or owner_id is None:
+            return key_cls.Read(key_json)
+
+        cache_key = (owner_id, key_cls.__name__, sha256(key_json).hexdigest())
+        key = self.get(cache_key)
+        if key is None:
+            key = key_cls.Read(key_json)
+            self.put(cache_key, key)
+        return key
+
+    def public_key(self, owner_id, key_json):
+        """Return the parsed RsaPublicKey for key_json (see _get)"""
+        return self._get(RsaPublicKey, owner_id, key_json)
+
+    def private_key(self, owner_id, key_json):
+        """Return the parsed RsaPrivateKey for key_json (see _get)"""
+        return self._get(RsaPrivateKey, owner_id, key_json)
+
+
+class VerificationCache(LRUCache):
+    """Cache of signatures that have been successfully verified
+
+    Entries are keyed by the signing Persona's id, the sha256 digest of the
+    signed data and the signature itself. Only valid signatures are stored, so
+    a miss always results in a full RSA verification.
+    """
+
+    def verified(self, owner_id, data, signature):
+        """Return True if signature on data has already been verified for owner_id"""
+        return self.get((owner_id, sha256(data).hexdigest(), signature)) is not None
+
+    def add(self, owner_id, data, signature):
+        """Remember signature on data as valid for owner_id"""
+        self.put((owner_id, sha256(data).hexdigest(), signature), True)
+
+
+class ContentKeyCache(LRUCache):
+    """Memory-only cache of the AES content keys of Vesicles
+
+    Recovering the content key of an encrypted Vesicle requires an RSA
+    decryption of the author's keycrypt entry. Keys are cached by Vesicle id
+    for `ttl` seconds and overwritten with zeros when they leave the cache.
+
+    Args:
+        maxsize (int): Maximum number of keys kept in memory
+        ttl (int): Seconds after which a key is removed
+    """
+
+    def __init__(self, maxsize=256, ttl=600):
+        LRUCache.__init__(self, maxsize=maxsize)
+        self.ttl = ttl
+
+    def _discard(self, value):
+        """Overwrite a removed key in memory"""
+        key, expires = value
+        for i in xrange(len(key)):
+            key[i] = 0
+
+    def _purge_expired(self):
+        """Remove all expired keys"""
+        now = time.time()
+        for vesicle_key in [k for k, v in self._entries.iteritems() if v[1] < now]:
+            self._discard(self._entries.pop(vesicle_key))
+
+    def get_key(self, vesicle_id):
+        """Return the cached content key of a Vesicle
+
+        Returns:
+            String: The content key
+            None: If the key is not cached or has expired
+        """
+        value = self.get((vesicle_id, ))
+        if value is None:
+            return None
+
+        if value[1] < time.time():
+            self.hits -= 1
+            self.misses += 1
+            self._discard(self._entries.pop((vesicle_id, )))
+            return None
+        return str(value[0])
+
+    def put_key(self, vesicle_id, hashcode):
+        """Cache the content key of a Vesicle for `ttl` seconds"""
+        self._purge_expired()
+        self.put((vesicle_id, ), (bytearray(hashcode), time.time() + self.ttl))
+
+
+def _use_thread_locks_for_rng():
+    """Replace the locks of pycrypto's random number generator with real thread locks
+
+    Monkey patching turns them into greenlet locks, which can't be waited for
+    in a worker thread. Holding them never yields, so a greenlet that waits
+    for a real lock held by a worker only blocks for a moment.
+    """
+    from gevent.monkey import get_original
+    from Crypto.Random import _UserFriendlyRNG
+
+    allocate_lock = get_original("thread", "allocate_lock")
+    _UserFriendlyRNG._singleton_lock = allocate_lock()
+    _UserFriendlyRNG._get_singleton()._lock = allocate_lock()
+
+
+class CryptoExecutor(object):
+    """Runs CPU-bound crypto operations outside of the gevent hub
+
+    RSA and AES calls block the greenlet loop that serves both the web UI and
+    the Synapse. Dispatching them to a gevent threadpool keeps the hub
+    responsive while they run. Functions passed to the executor must not use
+    the executor themselves, and must not wait for locks shared with
+    greenlets: after gevent's monkey patching these raise LoopExit in worker
+    threads. The random number generator of pycrypto is given real thread
+    locks for this reason when the pool is created.
+
+    Args:
+        workers (int): Number of worker threads. With 0 workers every
+            operation runs synchronously in the calling greenlet.
+    """
+
+    def __init__(self, workers=0):
+        self.workers = workers
+        self._pool = None
+
+    def _get_pool(self):
+        """Return the threadpool, creating it on first use (after gevent has been patched)"""
+        if self._pool is None:
+            from gevent.threadpool import ThreadPool
+            _use_thread_locks_for_rng()
+            self._pool = ThreadPool(self.workers)
+        return self._pool
+
+    @staticmethod
+    def _call(func, args):
+        """Return (True, result) of func(*args), or (False, exc_info) if it raises"""
+        try:
+            return True, func(*args)
+        except BaseException:
+            return False, sys.exc_info()
+
+    def apply(self, func, *args):
+        """Call func with args in a worker thread and return its result
+
+        Exceptions raised by func are re-raised in the calling greenlet.
+        """
+        if self.workers < 1:
+            return func(*args)
+
+        # gevent's ThreadPool returns None instead of raising if func fails
+        result = self._get_pool().apply(self._call, (func, args))
+        if result is None:
+            raise RuntimeError("Crypto worker failed to run {}".format(func))
+
+        ok, value = result
+        if not ok:
+            raise value[0], value[1], value[2]
+        return value
+
+    def map(self, func, iterable):
+        """Return the list of func applied to all items of iterable, computed by all workers
+
+        The first exception raised by func is re-raised in the calling greenlet.
+        """
+        if self.workers < 1:
+            return map(func, iterable)
+
+        results = self._get_pool().map(lambda item: self._call(func, (item, )), iterable)
+        values = list()
+        for result in results:
+            if result is None:
+                raise RuntimeError("Crypto worker failed to run {}".format(func))
+            ok, value = result
+            if not ok:
+                raise value[0], value[1], value[2]
+            values.append(value)
+        return values
+
+    def shutdown(self):
+        """Stop all worker threads"""
+        if self._pool is not None:
+            self._pool.kill()
+            self._pool = None
+
+class KeyFactory(object):
+    """Pool of pre-generated RSA private keys
+
+    Generating a keypair takes seconds, which makes creating Personas, Groups
+    and Soumas slow. The factory keeps a number of keys ready, stores them in
+    the user data directory and refills the pool in the background whenever a
+    key is taken.
+
+    The pool file is encrypted with a key derived from SECRET_KEY, which is
+    stored in the same directory. This only keeps the keys from being read
+    at a glance and protects them no better than the private keys of
+    Personas, which are stored unencrypted in the database.
+
+    Args:
+        size (int): Number of keys to keep ready
+        filename (String): (Optional) path of the file the pool is stored in.
+            Defaults to the KEYPAIR_POOL_FILE setting at the time of use.
+    """
+
+    def __init__(self, size, filename=None):
+        self.size = size
+        self._filename = filename
+        self._keys = None
+        self._refill = None
+
+    @property
+    def filename(self):
+        return self._filename or app.config["KEYPAIR_POOL_FILE"]
+
+    def __len__(self):
+        return len(self._get_keys())
+
+    def _storage_key(self):
+        """Return the AES key used for encrypting the pool file"""
+        h = sha256(app.config["SECRET_KEY"] + "keypool").hexdigest()[:32]
+        return AesKey(h, HmacKey(h), 256)
+
+    def _get_keys(self):
+        """Return the list of JSON encoded keys in the pool, loading it from disk if neccessary"""
+        if self._keys is None:
+            try:
+                with open(self.filename, 'rb') as f:
+                    self._keys = json.loads(self._storage_key().Decrypt(f.read()))
+            except (IOError, ValueError, KeyczarError), e:
+                if os.path.exists(self.filename):
+                    app.logger.warning("Discarding unreadable keypair pool: {}".format(e))
+                self._keys = list()
+        return self._keys
+
+    def _store(self):
+        """Write the pool to disk"""
+        data = self._storage_key().Encrypt(json.dumps(self._get_keys()))
+        with open(self.filename, 'wb') as f:
+            os.chmod(self.filename, 0600)
+            f.write(data)
+
+    def _refill_pool(self):
+        """Generate keys until the pool is full"""
+        keys = self._get_keys()
+        while len(keys) < self.size:
+            key = crypto_executor.apply(RsaPrivateKey.Generate)
+            if not isinstance(key, RsaPrivateKey):
+                app.logger.error("Keypair generation failed, keypair pool not refilled")
+                return
+            keys.append(str(key))
+            self._store()
+        app.logger.debug("Keypair pool filled with {} keys".format(len(keys)))
+
+    def refill_async(self):
+        """Start refilling the pool in a background greenlet unless it is already running"""
+        if self.size > 0 and (self._refill is None or self._refill.ready()):
+            self._refill = spawn(self._refill_pool)
+
+    def take(self):
+        """Return a new RsaPrivateKey, generating it right away if the pool is empty
+
+        Returns:
+            RsaPrivateKey: A key that has not been handed out before
+        """
+        keys = self._get_keys()
+        key = None
+        while key is None and len(keys) > 0:
+            try:
+                key = RsaPrivateKey.Read(keys.pop(0))
+            except (KeyczarError, KeyError, ValueError, TypeError), e:
+                app.logger.warning("Discarding invalid key from keypair pool: {}".format(e))
+            self._store()
+
+        if key is None:
+            key = crypto_executor.apply(RsaPrivateKey.Generate)
+
+        self.refill_async()
+        return key
+
+# Parsed keys of all Identities and Soumas
+key_cache = KeyCache(maxsize=app.config["KEY_CACHE_SIZE"])
+
+# Vesicle signatures that don't need to be verified again
+verification_cache = VerificationCache(maxsize=app.config["VERIFICATION_CACHE_SIZE"])
+
+# Content keys of Vesicles recovered for re-distribution
+content_key_cache = ContentKeyCache(
+    maxsize=app.config["CONTENT_KEY_CACHE_SIZE"],
+    ttl=app.config["CONTENT_KEY_CACHE_TTL"])
+
+# Worker threads for RSA and AES operations
+crypto_executor = CryptoExecutor(workers=app.config["CRYPTO_WORKERS"])
+
+# Pre-generated RSA keys for new Identities and Soumas
+key_factory = KeyFactory(size=app.config["KEYPAIR_POOL_SIZE"])
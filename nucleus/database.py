@@ -1,6 +1,10 @@
+import json
+
+from sqlalchemy import inspect, text
 from sqlalchemy.exc import OperationalError
 
 from nucleus.models import *
+from nucleus.vesicle import Vesicle, SEND_ATTRIBUTES, send_attribute_mask, t_vesicle_recipients
 
 
 def initialize_database(app, db):
@@ -22,4 +26,106 @@ def initialize_database(app, db):
         app.logger.info("Setting up database")
         db.create_all()
 
-    # TODO: Update database
+    # Update database
+    _migrate_send_attributes(app, db)
+    _migrate_vesicle_recipients(app, db)
+    _migrate_pending_objects(app, db)
+    _migrate_outbox(app, db)
+    _migrate_glia_sessions(app, db)
+
+
+def _migrate_send_attributes(app, db):
+    """Store Vesicle send attributes as a bitmask instead of a JSON list
+
+    Args:
+        app: Flask app object
+        db: Flask-SQLAlchemy object
+    """
+    columns = [c["name"] for c in inspect(db.engine).get_columns("vesicle")]
+    if "send_attribute_mask" in columns:
+        return
+
+    app.logger.info("Updating database: Converting Vesicle send attributes to bitmask")
+    db.engine.execute("ALTER TABLE vesicle ADD COLUMN send_attribute_mask INTEGER")
+
+    if "_send_attributes" in columns:
+        rows = db.engine.execute("SELECT id, _send_attributes FROM vesicle").fetchall()
+        for vesicle_id, send_attributes in rows:
+            try:
+                attrs = [a for a in json.loads(send_attributes) if a in SEND_ATTRIBUTES]
+            except (TypeError, ValueError):
+                app.logger.warning("Vesicle [{}] has invalid send attributes".format(vesicle_id[:6]))
+                attrs = Vesicle._default_send_attributes
+
+            db.engine.execute(text("UPDATE vesicle SET send_attribute_mask = :mask WHERE id = :id"),
+                mask=send_attribute_mask(attrs), id=vesicle_id)
+
+
+def _migrate_vesicle_recipients(app, db):
+    """Create the vesicle_recipient table and fill it from all stored keycrypts
+
+    Args:
+        app: Flask app object
+        db: Flask-SQLAlchemy object
+    """
+    if "vesicle_recipient" in inspect(db.engine).get_table_names():
+        return
+
+    app.logger.info("Updating database: Indexing Vesicle recipients")
+    t_vesicle_recipients.create(db.engine)
+
+    rows = list()
+    for vesicle_id, keycrypt in db.engine.execute("SELECT id, keycrypt FROM vesicle"):
+        try:
+            keycrypt = json.loads(keycrypt) if keycrypt else dict()
+        except ValueError:
+            app.logger.warning("Vesicle [{}] has invalid keycrypt".format(vesicle_id[:6]))
+            continue
+
+        rows.extend({"vesicle_id": vesicle_id, "persona_id": persona_id, "wrapped_key": wrapped_key}
+            for persona_id, wrapped_key in keycrypt.iteritems())
+
+    if rows:
+        db.engine.execute(t_vesicle_recipients.insert(), rows)
+
+
+def _migrate_pending_objects(app, db):
+    """Create the pending_object table
+
+    Args:
+        app: Flask app object
+        db: Flask-SQLAlchemy object
+    """
+    if "pending_object" in inspect(db.engine).get_table_names():
+        return
+
+    app.logger.info("Updating database: Creating table of pending object requests")
+    PendingObject.__table__.create(db.engine)
+
+
+def _migrate_outbox(app, db):
+    """Create the outbox_vesicle table
+
+    Args:
+        app: Flask app object
+        db: Flask-SQLAlchemy object
+    """
+    if "outbox_vesicle" in inspect(db.engine).get_table_names():
+        return
+
+    app.logger.info("Updating database: Creating Myelin outbox")
+    OutboxVesicle.__table__.create(db.engine)
+
+
+def _migrate_glia_sessions(app, db):
+    """Create the glia_session table
+
+    Args:
+        app: Flask app object
+        db: Flask-SQLAlchemy object
+    """
+    if "glia_session" in inspect(db.engine).get_table_names():
+        return
+
+    app.logger.info("Updating database: Creating Glia session store")
+    GliaSession.__table__.create(db.engine)
@@ -47,6 +47,7 @@ def _configure_from_args(app, args):
         app.config['SQLALCHEMY_DATABASE_URI'] = "sqlite:///" + app.config['DATABASE']
         app.config["SECRET_KEY_FILE"] = os.path.join(app.config["USER_DATA"], "secret_key_{}.dat".format(args.port))
         app.config["PASSWORD_HASH_FILE"] = os.path.join(app.config["USER_DATA"], "pw_hash_{}.dat".format(args.port))
+        app.config["KEYPAIR_POOL_FILE"] = os.path.join(app.config["USER_DATA"], "keypool_{}.dat".format(args.port))
 
     if args.reset is True:
         from web_ui.helpers import reset_userdata
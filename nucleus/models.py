@@ -6,13 +6,13 @@ import semantic_version
 from base64 import b64encode, b64decode
 from flask import url_for, session
 from hashlib import sha256
-from keyczar.keys import RsaPrivateKey, RsaPublicKey
-from sqlalchemy import ForeignKey
+from sqlalchemy import ForeignKey, event
 from sqlalchemy.orm import remote
 from uuid import uuid4
 
 from nucleus import ONEUP_STATES, STAR_STATES, PLANET_STATES, \
-    PersonaNotFoundError, UnauthorizedError, notification_signals, CHANGE_TYPES
+    PersonaNotFoundError, UnauthorizedError, notification_signals, CHANGE_TYPES, commit_session
+from nucleus.crypto import crypto_executor, key_cache, key_factory, verification_cache
 from web_ui import app, db
 from web_ui.helpers import epoch_seconds
 
@@ -230,40 +230,40 @@ class Identity(Serializable, db.Model):
         """ Generate new RSA keypairs for signing and encrypting. Commit to DB afterwards! """
 
         # TODO: Store keys encrypted
-        rsa1 = RsaPrivateKey.Generate()
+        rsa1 = key_factory.take()
         self.sign_private = str(rsa1)
         self.sign_public = str(rsa1.public_key)
 
-        rsa2 = RsaPrivateKey.Generate()
+        rsa2 = key_factory.take()
         self.crypt_private = str(rsa2)
         self.crypt_public = str(rsa2.public_key)
 
     def encrypt(self, data):
         """ Encrypt data using RSA """
 
-        key_public = RsaPublicKey.Read(self.crypt_public)
-        return b64encode(key_public.Encrypt(data))
+        key_public = key_cache.public_key(self.id, self.crypt_public)
+        return b64encode(crypto_executor.apply(key_public.Encrypt, data))
 
     def decrypt(self, cypher):
         """ Decrypt cyphertext using RSA """
 
         cypher = b64decode(cypher)
-        key_private = RsaPrivateKey.Read(self.crypt_private)
-        return key_private.Decrypt(cypher)
+        key_private = key_cache.private_key(self.id, self.crypt_private)
+        return crypto_executor.apply(key_private.Decrypt, cypher)
 
     def sign(self, data):
         """ Sign data using RSA """
 
-        key_private = RsaPrivateKey.Read(self.sign_private)
-        signature = key_private.Sign(data)
+        key_private = key_cache.private_key(self.id, self.sign_private)
+        signature = crypto_executor.apply(key_private.Sign, data)
         return b64encode(signature)
 
     def verify(self, data, signature_b64):
         """ Verify a signature using RSA """
 
         signature = b64decode(signature_b64)
-        key_public = RsaPublicKey.Read(self.sign_public)
-        return key_public.Verify(data, signature)
+        key_public = key_cache.public_key(self.id, self.sign_public)
+        return crypto_executor.apply(key_public.Verify, data, signature)
 
     @staticmethod
     def create_from_changeset(changeset, stub=None, update_sender=None, update_recipient=None, kind=None):
@@ -396,6 +396,15 @@ class Persona(Identity):
     index_id = db.Column(db.String(32), db.ForeignKey('starmap.id'))
     index = db.relationship('Starmap', primaryjoin='starmap.c.id==persona.c.index_id')
 
+    # Stored Vesicles that have this Persona in their keycrypt
+    readable_vesicles = db.relationship(
+        'Vesicle',
+        secondary='vesicle_recipient',
+        lazy="dynamic",
+        viewonly=True,
+        primaryjoin='vesicle_recipient.c.persona_id==persona.c.id',
+        secondaryjoin='vesicle_recipient.c.vesicle_id==vesicle.c.id')
+
     # Myelin offset stores the date at which the last Vesicle receieved from Myelin was created
     myelin_offset = db.Column(db.DateTime)
 
@@ -456,7 +465,11 @@ class Persona(Identity):
             None: If no record was found
         """
         from synapse import ElectricalSynapse
-        electrical = ElectricalSynapse()
+
+        # Creating the ElectricalSynapse again would reset its sessions and jobs
+        electrical = getattr(ElectricalSynapse, "_instance", None)
+        if electrical is None:
+            return Persona.query.get(persona_id)
         return electrical.get_persona(persona_id)
 
     @staticmethod
@@ -619,6 +632,41 @@ class Persona(Identity):
         return request_list
 
 
+class ControlledPersonas(object):
+    """In-memory set of the IDs of all Personas controlled by this Souma
+
+    The set is loaded from the database on first use and kept current by
+    listening to the `local-model-changed` signal.
+    """
+
+    def __init__(self):
+        self._ids = None
+
+    def __contains__(self, persona_id):
+        return persona_id in self.ids()
+
+    def ids(self):
+        """Return the set of controlled Persona IDs"""
+        if self._ids is None:
+            self._ids = set(pid for (pid,) in db.session.query(Persona.id).filter('sign_private != ""'))
+        return self._ids
+
+    def on_local_model_changed(self, sender, message):
+        """Add new controlled Personas to the set and remove deleted ones"""
+        if message["object_type"] != "Persona" or self._ids is None:
+            return
+
+        if message["action"] == "insert":
+            persona = Persona.query.get(message["object_id"])
+            if persona is not None and persona.controlled():
+                self._ids.add(persona.id)
+        elif message["action"] == "delete":
+            self._ids.discard(message["object_id"])
+
+controlled_personas = ControlledPersonas()
+notification_signals.signal('local-model-changed').connect(controlled_personas.on_local_model_changed)
+
+
 t_star_vesicles = db.Table(
     'star_vesicles',
     db.Column('star_id', db.String(32), db.ForeignKey('star.id')),
@@ -759,12 +807,16 @@ class Star(Serializable, db.Model):
             if parent:
                 star.parent = parent
             else:
+                # The parent relationship is loaded once the parent has been received
+                star.parent_id = changeset["parent_id"]
                 app.logger.info("Requesting {}'s parent star".format(star))
-                request_objects.send({
+                request_objects.send(Star.create_from_changeset, message={
                     "type": "Star",
                     "id": changeset["parent_id"],
                     "author_id": update_recipient.id,
                     "recipient_id": update_sender.id,
+                    "dependent_type": "Star",
+                    "dependent_id": star.id
                 })
 
         return star
@@ -778,6 +830,12 @@ class Star(Serializable, db.Model):
         # Update text
         self.text = changeset["text"]
 
+        # Insert changesets are re-applied once a missing parent has arrived
+        if changeset.get("parent_id", "None") != "None" and self.parent is None:
+            parent = Star.query.get(changeset["parent_id"])
+            if parent is not None:
+                self.parent = parent
+
         for planet_assoc in changeset["planet_assocs"]:
             if not PlanetAssociation.validate_changeset(planet_assoc):
                 app.logger.warning("Invalid changeset for planet associated with {}\n{}".format(self, changeset))
@@ -785,7 +843,7 @@ class Star(Serializable, db.Model):
                 author = Persona.request_persona(planet_assoc["author_id"])
                 pid = planet_assoc["planet"]["id"]
 
-                assoc = PlanetAssociation.filter_by(star_id=self.id).filter_by(planet_id=pid).first()
+                assoc = PlanetAssociation.query.filter_by(star_id=self.id).filter_by(planet_id=pid).first()
                 if assoc is None:
                     planet = Planet.query.get(pid)
                     if planet is None:
@@ -1390,11 +1448,11 @@ class Souma(Serializable, db.Model):
         """ Generate new RSA keypairs for signing and encrypting. Commit to DB afterwards! """
 
         # TODO: Store keys encrypted
-        rsa1 = RsaPrivateKey.Generate()
+        rsa1 = key_factory.take()
         self.sign_private = str(rsa1)
         self.sign_public = str(rsa1.public_key)
 
-        rsa2 = RsaPrivateKey.Generate()
+        rsa2 = key_factory.take()
         self.crypt_private = str(rsa2)
         self.crypt_public = str(rsa2.public_key)
 
@@ -1404,8 +1462,8 @@ class Souma(Serializable, db.Model):
         if self.crypt_public == "":
             raise ValueError("Error encrypting: No public encryption key found for {}".format(self))
 
-        key_public = RsaPublicKey.Read(self.crypt_public)
-        return key_public.Encrypt(data)
+        key_public = key_cache.public_key(self.id, self.crypt_public)
+        return crypto_executor.apply(key_public.Encrypt, data)
 
     def decrypt(self, cypher):
         """ Decrypt cyphertext using RSA """
@@ -1413,8 +1471,8 @@ class Souma(Serializable, db.Model):
         if self.crypt_private == "":
             raise ValueError("Error decrypting: No private encryption key found for {}".format(self))
 
-        key_private = RsaPrivateKey.Read(self.crypt_private)
-        return key_private.Decrypt(cypher)
+        key_private = key_cache.private_key(self.id, self.crypt_private)
+        return crypto_executor.apply(key_private.Decrypt, cypher)
 
     @property
     def version(self):
@@ -1434,8 +1492,8 @@ class Souma(Serializable, db.Model):
         if self.sign_private == "":
             raise ValueError("Error signing: No private signing key found for {}".format(self))
 
-        key_private = RsaPrivateKey.Read(self.sign_private)
-        signature = key_private.Sign(data)
+        key_private = key_cache.private_key(self.id, self.sign_private)
+        signature = crypto_executor.apply(key_private.Sign, data)
         return urlsafe_b64encode(signature)
 
     def verify(self, data, signature_b64):
@@ -1446,8 +1504,26 @@ class Souma(Serializable, db.Model):
             raise ValueError("Error verifying: No public signing key found for {}".format(self))
 
         signature = urlsafe_b64decode(signature_b64)
-        key_public = RsaPublicKey.Read(self.sign_public)
-        return key_public.Verify(data, signature)
+        key_public = key_cache.public_key(self.id, self.sign_public)
+        return crypto_executor.apply(key_public.Verify, data, signature)
+
+
+def _invalidate_parsed_keys(target, value, oldvalue, initiator):
+    """Remove parsed keys of an Identity or Souma from the key cache when one of its keys is replaced"""
+    if value != oldvalue and target.id is not None:
+        key_cache.invalidate(target.id)
+
+
+def _invalidate_verified_signatures(target, value, oldvalue, initiator):
+    """Forget signatures verified with an Identity's previous public signing key"""
+    if value != oldvalue and target.id is not None:
+        verification_cache.invalidate(target.id)
+
+for key_attr in ["crypt_private", "crypt_public", "sign_private", "sign_public"]:
+    event.listen(getattr(Identity, key_attr), 'set', _invalidate_parsed_keys, propagate=True)
+    event.listen(getattr(Souma, key_attr), 'set', _invalidate_parsed_keys)
+
+event.listen(Identity.sign_public, 'set', _invalidate_verified_signatures, propagate=True)
 
 t_starmap = db.Table(
     'starmap_index',
@@ -1667,12 +1743,12 @@ class Starmap(Serializable, db.Model):
                         )
                         star.set_state(-1)
                         db.session.add(star)
-                        db.session.commit()
+                        commit_session()
 
             new_starmap.index.append(star)
 
         db.session.add(new_starmap)
-        db.session.commit()
+        commit_session()
 
         for req in request_list:
             request_objects.send(Starmap.create_from_changeset, message=req)
@@ -1723,7 +1799,7 @@ class Starmap(Serializable, db.Model):
                         )
                         star.set_state(-1)
                         db.session.add(star)
-                        db.session.commit()
+                        commit_session()
 
             self.index.append(star)
             added_stars.append(star)
@@ -2008,3 +2084,106 @@ class Group(Identity):
 
         for req in request_list:
             request_objects.send(Group.update_from_changeset, message=req)
+
+
+class PendingObject(db.Model):
+    """An object that has been requested from a peer but not received yet
+
+    Requests for pending objects are suppressed until the previous request
+    has timed out. The timeout starts at OBJECT_REQUEST_TTL seconds and
+    doubles with every attempt, up to OBJECT_REQUEST_MAX_BACKOFF.
+
+    Attributes:
+        object_type: Capitalized class name of the object
+        object_id: ID of the object
+        author_id: ID of the Persona that sent the last request
+        source_id: ID of the Persona the object was last requested from
+        requested_at: Datetime of the last request
+        attempts: Number of requests sent
+        dependents: JSON list of (type, id) pairs of objects that refer to this object
+    """
+
+    __tablename__ = "pending_object"
+
+    object_type = db.Column(db.String(32), primary_key=True)
+    object_id = db.Column(db.String(32), primary_key=True)
+    author_id = db.Column(db.String(32))
+    source_id = db.Column(db.String(32))
+    requested_at = db.Column(db.DateTime)
+    attempts = db.Column(db.Integer, default=0)
+    dependents = db.Column(db.Text, default="[]")
+
+    def __repr__(self):
+        return "<PendingObject {} [{}] ({} attempts)>".format(
+            self.object_type, self.object_id[:6], self.attempts)
+
+    def get_dependents(self):
+        """Return a list of (type, id) tuples of the objects waiting for this object"""
+        return [tuple(d) for d in json.loads(self.dependents or "[]")]
+
+    def add_dependent(self, object_type, object_id):
+        """Record that the object with object_type and object_id waits for this object"""
+        dependents = self.get_dependents()
+        if (object_type, object_id) not in dependents:
+            dependents.append((object_type, object_id))
+            self.dependents = json.dumps(dependents)
+
+    def next_attempt(self):
+        """Return the datetime after which the object may be requested again"""
+        if self.requested_at is None or not self.attempts:
+            return datetime.datetime.min
+
+        backoff = min(app.config["OBJECT_REQUEST_TTL"] * 2 ** (self.attempts - 1),
+            app.config["OBJECT_REQUEST_MAX_BACKOFF"])
+        return self.requested_at + datetime.timedelta(seconds=backoff)
+
+    def due(self):
+        """Return True if the last request for this object has timed out"""
+        return self.next_attempt() <= datetime.datetime.utcnow()
+
+
+class OutboxVesicle(db.Model):
+    """A serialized Vesicle waiting to be uploaded to Myelin
+
+    A Vesicle that is distributed to different recipients is queued once for
+    every set of recipients, as each copy has its own keycrypt.
+
+    Attributes:
+        vesicle_id: ID of the Vesicle
+        recipients: SHA1 hexdigest of the sorted recipient IDs in the keycrypt
+        data: JSON encoded Vesicle as returned by Vesicle.json()
+        queued_at: Datetime at which this version of the Vesicle was queued
+        attempts: Number of failed uploads
+        next_attempt: Datetime before which no upload is attempted
+    """
+
+    __tablename__ = "outbox_vesicle"
+
+    vesicle_id = db.Column(db.String(32), primary_key=True)
+    recipients = db.Column(db.String(40), primary_key=True, default="")
+    data = db.Column(db.Text)
+    queued_at = db.Column(db.DateTime)
+    attempts = db.Column(db.Integer, default=0)
+    next_attempt = db.Column(db.DateTime)
+
+    def __repr__(self):
+        return "<OutboxVesicle [{}] ({} attempts)>".format(self.vesicle_id[:6], self.attempts)
+
+
+class GliaSession(db.Model):
+    """A Glia session of a controlled Persona, kept for reuse after a restart
+
+    Attributes:
+        persona_id: ID of the logged in Persona
+        session_id: ID of the session on the Glia server
+        timeout: Datetime (UTC) at which the session expires
+    """
+
+    __tablename__ = "glia_session"
+
+    persona_id = db.Column(db.String(32), primary_key=True)
+    session_id = db.Column(db.String(32))
+    timeout = db.Column(db.DateTime)
+
+    def __repr__(self):
+        return "<GliaSession [{}] of [{}] until {}>".format(self.session_id[:6], self.persona_id[:6], self.timeout)
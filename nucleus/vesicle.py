@@ -2,19 +2,112 @@ import json
 import datetime
 import iso8601
 import keyczar
+import zlib
 
 from base64 import b64encode, b64decode
 from hashlib import sha256
 from keyczar.keys import AesKey, HmacKey
+from sqlalchemy import event, inspect
 
+from nucleus import wire
 from nucleus import PersonaNotFoundError, InvalidSignatureError, UnauthorizedError, VesicleStateError
-from nucleus.models import Persona
+from nucleus.crypto import content_key_cache, crypto_executor, key_cache, verification_cache
+from nucleus.models import Persona, controlled_personas
 from web_ui import app, db
 
 VESICLE_VERSION = "0.1"
 DEFAULT_ENCODING = "{version}-{encoding}".format(version=VESICLE_VERSION, encoding="plain")
 SYNAPSE_PORT = None
 AES_BYTES = 256
+COMPRESSION = "zlib"
+
+# Attributes that can be sent with a Vesicle. The position of an attribute in
+# this list is its bit in Vesicle.send_attribute_mask, so new attributes must
+# only be appended.
+SEND_ATTRIBUTES = ["message_type", "id", "payload", "enc", "author_id", "keycrypt", "signature"]
+
+# Payload encodings this Souma can read
+ENCODINGS = ["plain", "AES-{}".format(AES_BYTES), "AES-{}-{}".format(AES_BYTES, COMPRESSION)]
+
+
+def send_attribute_mask(send_attributes):
+    """
+    Return the bitmask representing a list of send attributes
+
+    Args:
+        send_attributes (list): Names of Vesicle attributes from SEND_ATTRIBUTES
+
+    Returns:
+        int: Bitmask with the bits of all send attributes set
+
+    Raises:
+        ValueError: If one of the attributes is not in SEND_ATTRIBUTES
+    """
+    mask = 0
+    for attr in send_attributes:
+        if attr not in SEND_ATTRIBUTES:
+            raise ValueError("Unknown Vesicle send attribute: {}".format(attr))
+        mask |= 1 << SEND_ATTRIBUTES.index(attr)
+    return mask
+
+
+def verify_signature(author_id, sign_public, payload, signature):
+    """
+    Return True if signature is a valid signature of payload by its author
+
+    Only uses its arguments and the caches of nucleus.crypto, not the database.
+
+    Args:
+        author_id (String): ID of the signing Persona
+        sign_public (String): Public signing key of the author
+        payload (String): Signed data
+        signature (String): Base64 encoded signature
+    """
+    if verification_cache.verified(author_id, payload, signature):
+        return True
+
+    key_public = key_cache.public_key(author_id, sign_public)
+    valid = crypto_executor.apply(key_public.Verify, payload, b64decode(signature))
+    if valid:
+        verification_cache.add(author_id, payload, signature)
+    return valid
+
+
+def decrypt_payload(reader_id, crypt_private, wrapped_key, payload, compressed):
+    """
+    Decrypt an encrypted Vesicle payload
+
+    Only uses its arguments and the caches of nucleus.crypto, not the database.
+
+    Args:
+        reader_id (String): ID of the Persona decrypting the payload
+        crypt_private (String): Private encryption key of the reader
+        wrapped_key (String): The reader's entry in the keycrypt
+        payload (String): Base64 encoded ciphertext
+        compressed (Boolean): Whether the plaintext is compressed
+
+    Returns:
+        tuple: The content key (hashcode) and the decoded payload
+    """
+    key_private = key_cache.private_key(reader_id, crypt_private)
+    hashcode = crypto_executor.apply(key_private.Decrypt, b64decode(wrapped_key))
+
+    # Generate the AES key (see Vesicle.encrypt())
+    key = AesKey(hashcode, HmacKey(hashcode), AES_BYTES)
+    data = crypto_executor.apply(key.Decrypt, b64decode(payload))
+
+    if compressed:
+        data = zlib.decompress(data)
+
+    return hashcode, json.loads(data)
+
+
+t_vesicle_recipients = db.Table(
+    'vesicle_recipient',
+    db.Column('vesicle_id', db.String(32), db.ForeignKey('vesicle.id'), primary_key=True, index=True),
+    db.Column('persona_id', db.String(32), db.ForeignKey('persona.id'), primary_key=True, index=True),
+    db.Column('wrapped_key', db.Text)
+)
 
 
 class Vesicle(db.Model):
@@ -34,13 +127,23 @@ class Vesicle(db.Model):
     created = db.Column(db.DateTime, default=datetime.datetime.utcnow())
     keycrypt = db.Column(db.Text(), default='{}')
     enc = db.Column(db.String(16))
-    _send_attributes = db.Column(db.Text)
+    send_attribute_mask = db.Column(db.Integer)
     handled = db.Column(db.Boolean)
 
     author_id = db.Column(db.String(32), db.ForeignKey('persona.id', use_alter=True, name="fk_author_id"))
     author = db.relationship('Persona', primaryjoin="Persona.id==Vesicle.author_id", post_update=True)
 
+    # Recipients in the stored keycrypt (see _insert_recipients)
+    recipients = db.relationship('Persona',
+        secondary='vesicle_recipient',
+        lazy="dynamic",
+        viewonly=True,
+        primaryjoin='vesicle_recipient.c.vesicle_id==vesicle.c.id',
+        secondaryjoin='vesicle_recipient.c.persona_id==persona.c.id')
+
     _hashcode = None
+    _keycrypt_cache = None
+    _message_cache = None
     data = None
 
     def __init__(self, id, message_type, author=None, data=None, payload=None,
@@ -58,7 +161,7 @@ class Vesicle(db.Model):
             enc=enc,
             handled=handled)
 
-        self._send_attributes = json.dumps(Vesicle._default_send_attributes)
+        self.set_send_attributes(Vesicle._default_send_attributes)
 
     def __str__(self):
         """Return string identifier
@@ -77,8 +180,10 @@ class Vesicle(db.Model):
         try:
             if not self.decrypted():
                 desc = "encrypted"
+            elif self.message_type == "object_request" and "objects" in self.data:
+                desc = "{} objects".format(len(self.data["objects"]))
             elif self.message_type == "object_request":
-                desc = "<{} [{}]>".format(self.data["type"], self.data["id"][:6])
+                desc = "<{} [{}]>".format(self.data["object_type"], self.data["object_id"][:6])
             else:
                 desc = "{}-<{} [{}]>".format(self.data["action"], self.data["object_type"], self.data["obj"]["id"])
         except KeyError:
@@ -154,18 +259,26 @@ class Vesicle(db.Model):
         h = self._get_hashcode(payload=payload)
         key = AesKey(h, HmacKey(h), AES_BYTES)
 
+        # Compress large payloads before encrypting them. The hashcode is
+        # always derived from the uncompressed payload.
+        enc = "{version}-AES-{bytes}".format(version=self.enc.split("-")[0], bytes=AES_BYTES)
+        if app.config["VESICLE_COMPRESSION"] and len(payload) >= app.config["VESICLE_COMPRESSION_MIN_SIZE"]:
+            payload = zlib.compress(payload)
+            enc = "{}-{}".format(enc, COMPRESSION)
+
         # Encrypt payload using the AES key
-        payload_encrypted = b64encode(key.Encrypt(payload))
+        payload_encrypted = b64encode(crypto_executor.apply(key.Encrypt, payload))
 
         self.payload = payload_encrypted
         self.data = None
         self.signature = None  # must re-sign after encryption
-        self.enc = "{version}-AES-{bytes}".format(version=self.enc.split("-")[0], bytes=AES_BYTES)
+        self.enc = enc
 
         self.add_send_attribute("author_id")
         self.add_send_attribute("keycrypt")
 
         self.add_recipients(recipients + [self.author], hashcode=h)
+        content_key_cache.put_key(self.id, h)
 
     def encrypted(self):
         """
@@ -196,13 +309,10 @@ class Vesicle(db.Model):
         if not self.encrypted():
             raise VesicleStateError("Cannot decrypt {}: Already plaintext.".format(self))
 
-        keycrypt = json.loads(self.keycrypt)
+        keycrypt = self.get_keycrypt()
 
         if reader_persona is None:
-            for p in Persona.query.filter('sign_private != ""'):
-                if p.id in keycrypt.keys():
-                    reader_persona = p
-                    continue
+            reader_persona = self.find_reader(keycrypt)
 
             if reader_persona is None:
                 raise UnauthorizedError(
@@ -212,19 +322,38 @@ class Vesicle(db.Model):
             if not reader_persona.id in keycrypt.keys():
                 raise UnauthorizedError("No key found decrypting {} for {}".format(self, reader_persona))
 
-        # Retrieve hashcode
-        self._hashcode = reader_persona.decrypt(keycrypt[reader_persona.id])
+        self._hashcode, self.data = decrypt_payload(reader_persona.id, reader_persona.crypt_private,
+            keycrypt[reader_persona.id], self.payload, self.compressed())
 
-        # Generate the AES key (see encrypt() above)
-        key = AesKey(self._hashcode, HmacKey(self._hashcode), AES_BYTES)
+        return reader_persona
+
+    def compressed(self):
+        """
+        Return True if the encrypted payload of this Vesicle is compressed
 
-        # Decrypt the data
-        data = key.Decrypt(b64decode(self.payload))
+        Returns:
+            Boolean: if compressed
+        """
+        return self.enc.endswith("-{}".format(COMPRESSION))
 
-        # Decode JSON
-        self.data = json.loads(data)
+    def find_reader(self, keycrypt=None):
+        """
+        Return a controlled Persona that is a recipient of this Vesicle
 
-        return reader_persona
+        Args:
+            keycrypt (dict): (Optional) decoded keycrypt to use instead of self.keycrypt
+
+        Returns:
+            Persona: A controlled Persona found in the keycrypt
+            None: If none of the recipients is controlled by this Souma
+        """
+        if keycrypt is None:
+            keycrypt = self.get_keycrypt()
+
+        for persona_id in keycrypt:
+            if persona_id in controlled_personas:
+                return Persona.query.get(persona_id)
+        return None
 
     def decrypted(self):
         """
@@ -235,22 +364,82 @@ class Vesicle(db.Model):
         """
         return self.data is not None
 
+    def get_keycrypt(self):
+        """
+        Return the keycrypt as a dictionary of recipient IDs and wrapped keys
+
+        The decoded dictionary is kept until self.keycrypt is replaced and must
+        not be modified in place. Store a changed copy with set_keycrypt().
+
+        Returns:
+            dict: The decoded keycrypt
+        """
+        if self._keycrypt_cache is None or self._keycrypt_cache[0] is not self.keycrypt:
+            self._keycrypt_cache = (self.keycrypt, json.loads(self.keycrypt))
+        return self._keycrypt_cache[1]
+
+    def set_keycrypt(self, keycrypt):
+        """
+        Serialize keycrypt into self.keycrypt
+
+        Args:
+            keycrypt (dict): Recipient IDs mapped to wrapped keys
+        """
+        self.keycrypt = json.dumps(keycrypt)
+        self._keycrypt_cache = (self.keycrypt, keycrypt)
+
+    @staticmethod
+    def readable_by(persona_id):
+        """
+        Return a query of all stored Vesicles that have persona_id in their keycrypt
+
+        Args:
+            persona_id (String): ID of a recipient Persona
+
+        Returns:
+            Query: Vesicle query
+        """
+        return Vesicle.query.join(t_vesicle_recipients, t_vesicle_recipients.c.vesicle_id == Vesicle.id) \
+            .filter(t_vesicle_recipients.c.persona_id == persona_id)
+
+    def stale_recipient_ids(self, recipient_ids):
+        """
+        Return the IDs of all Personas in the keycrypt that are not in recipient_ids
+
+        The stored recipient table is queried if the keycrypt has not been
+        modified since this Vesicle was loaded.
+
+        Args:
+            recipient_ids (list): IDs of current recipients
+
+        Returns:
+            set: IDs of Personas that are no longer recipients
+        """
+        state = inspect(self)
+        if not state.persistent or state.attrs.keycrypt.history.has_changes():
+            return set(self.get_keycrypt().keys()) - set(recipient_ids)
+
+        query = db.session.query(t_vesicle_recipients.c.persona_id) \
+            .filter(t_vesicle_recipients.c.vesicle_id == self.id)
+        if recipient_ids:
+            query = query.filter(~t_vesicle_recipients.c.persona_id.in_(recipient_ids))
+        return set(persona_id for (persona_id,) in query)
+
     def get_send_attributes(self):
-        return json.loads(self._send_attributes)
+        mask = self.send_attribute_mask or 0
+        return [attr for i, attr in enumerate(SEND_ATTRIBUTES) if mask & (1 << i)]
 
     def set_send_attributes(self, send_attributes):
-        self._send_attributes = json.dumps(send_attributes)
+        self.send_attribute_mask = send_attribute_mask(send_attributes)
 
     def add_send_attribute(self, attr):
-        send_attributes = self.get_send_attributes()
-        if send_attributes.count(attr) == 0:
-            send_attributes.append(attr)
-        self.set_send_attributes(send_attributes)
+        self.send_attribute_mask = (self.send_attribute_mask or 0) | send_attribute_mask([attr])
 
     def remove_send_attribute(self, attr):
-        send_attributes = self.get_send_attributes()
-        send_attributes.remove(attr)
-        self.set_send_attributes(send_attributes)
+        bit = send_attribute_mask([attr])
+        if not (self.send_attribute_mask or 0) & bit:
+            raise ValueError("{} is not a send attribute of {}".format(attr, self))
+        self.send_attribute_mask &= ~bit
 
     def sign(self):
         """
@@ -274,6 +463,9 @@ class Vesicle(db.Model):
         """
         Return True if vesicle has a signature and it is valid
 
+        Signatures that have been verified before are looked up in the
+        verification cache instead of being checked again.
+
         Returns:
             Boolean: If signed
         """
@@ -284,7 +476,7 @@ class Vesicle(db.Model):
         if not self.author:
             raise PersonaNotFoundError(self.author_id)
 
-        return self.author.verify(self.payload, self.signature)
+        return verify_signature(self.author.id, self.author.sign_public, self.payload, self.signature)
 
     def add_recipients(self, recipients, hashcode=None):
         """
@@ -302,18 +494,38 @@ class Vesicle(db.Model):
         if not self.encrypted():
             raise VesicleStateError("Can not add recipients to plaintext vesicles")
 
-        keycrypt = json.loads(self.keycrypt)
+        keycrypt = self.get_keycrypt()
 
         if hashcode is None:
             if not self.author.controlled():
                 raise UnauthorizedError("Must be Vesicle author to add recipients without known hashcode")
-            hashcode = self.author.decrypt(keycrypt[self.author_id])
 
+            hashcode = content_key_cache.get_key(self.id)
+            if hashcode is None:
+                hashcode = self.author.decrypt(keycrypt[self.author_id])
+                content_key_cache.put_key(self.id, hashcode)
+
+        new_recipients = dict()
         for recipient in recipients:
-            if recipient.id not in keycrypt.keys():
-                key = recipient.encrypt(hashcode)
-                keycrypt[recipient.id] = key
-        self.keycrypt = json.dumps(keycrypt)
+            if recipient.id not in keycrypt:
+                new_recipients[recipient.id] = recipient
+
+        # Wrapping the hashcode takes less than a millisecond per recipient.
+        # Spreading it over the crypto_executor's workers was measured to be
+        # slower than wrapping in the calling greenlet, as the workers share
+        # the GIL (20 recipients: 7.4 ms inline, 9.2 ms with 2 workers).
+        recipient_ids = new_recipients.keys()
+        wrapped_keys = list()
+        for r_id in recipient_ids:
+            key_public = key_cache.public_key(r_id, new_recipients[r_id].crypt_public)
+            wrapped_key = b64encode(key_public.Encrypt(hashcode))
+            if not wrapped_key:
+                raise VesicleStateError("Could not wrap the content key of {} for [{}]".format(self, r_id[:6]))
+            wrapped_keys.append(wrapped_key)
+
+        keycrypt = dict(keycrypt)
+        keycrypt.update(zip(recipient_ids, wrapped_keys))
+        self.set_keycrypt(keycrypt)
 
     def remove_recipient(self, recipient):
         """
@@ -328,20 +540,22 @@ class Vesicle(db.Model):
         if recipient.id == self.author_id:
             raise UnauthorizedError("Can't remove author from keycrypt")
 
-        keycrypt = json.loads(self.keycrypt)
+        keycrypt = dict(self.get_keycrypt())
         del keycrypt[recipient.id]
-        self.keycrypt = json.dumps(keycrypt)
+        self.set_keycrypt(keycrypt)
         app.logger.info("Removed {} as a recipient of {}".format(recipient, self))
 
-    def json(self, indent=False,):
+    def _cached_message(self):
         """
-        Generate JSON representation of this Vesicle, including all attributes defined in self._send_attributes.
+        Return the serialized attributes of this Vesicle, except for the timestamp
+
+        The result is kept until one of the send attributes or the set of
+        send attributes changes. Plaintext Vesicles are not cached because
+        changes to their data can't be detected.
 
         Returns:
-            String: JSON encoded Vesicle contents
+            tuple: Message dict and its JSON encoding
         """
-        indent = 4 if indent else None
-
         # Temporarily encode data if this is a plaintext message
         if self.payload is None:
             plainenc = True
@@ -349,41 +563,94 @@ class Vesicle(db.Model):
         else:
             plainenc = False
 
-        message = dict()
-        for attr in self.get_send_attributes():
-            message[attr] = getattr(self, attr)
-        message["created"] = datetime.datetime.utcnow().isoformat()
-        message["souma_id"] = app.config["SOUMA_ID"]
-        r = json.dumps(message, indent=indent)
+        send_attributes = self.get_send_attributes()
+        values = tuple(getattr(self, attr) for attr in send_attributes)
+        token = (self.send_attribute_mask, ) + values
+
+        if plainenc or self._message_cache is None \
+                or len(self._message_cache[0]) != len(token) \
+                or any(a is not b for a, b in zip(self._message_cache[0], token)):
+            message = dict(zip(send_attributes, values))
+            message["souma_id"] = app.config["SOUMA_ID"]
+            self._message_cache = (token, message, json.dumps(message))
 
         if plainenc:
             self.payload = None
-        return r
+        return self._message_cache[1:]
+
+    def message(self):
+        """
+        Return a dictionary of all attributes defined in self.send_attribute_mask.
+
+        Returns:
+            dict: Vesicle contents as they are sent to peers
+        """
+        message = dict(self._cached_message()[0])
+        message["created"] = datetime.datetime.utcnow().isoformat()
+        return message
+
+    def json(self, indent=False,):
+        """
+        Generate JSON representation of this Vesicle, including all attributes defined in self.send_attribute_mask.
+
+        Returns:
+            String: JSON encoded Vesicle contents
+        """
+        if indent:
+            return json.dumps(self.message(), indent=4)
+
+        # Splice the timestamp into the cached serialization
+        r = self._cached_message()[1]
+        return '{}, "created": {}}}'.format(r[:-1], json.dumps(datetime.datetime.utcnow().isoformat()))
+
+    def binary(self):
+        """
+        Generate compact binary representation of this Vesicle (see nucleus.wire)
+
+        Returns:
+            String: Binary encoded Vesicle contents
+        """
+        return wire.encode(self.message())
 
     @staticmethod
-    def read(data):
+    def read_binary(data, verify=True):
+        """
+        Create a vesicle instance from its binary representation (see read())
+
+        Raises:
+            ValueError: If data is not a valid binary Vesicle
+        """
+        return Vesicle.read(wire.decode(data), verify=verify)
+
+    @staticmethod
+    def read(data, verify=True):
         """
         Create a vesicle instance from its JSON representation. Checks signature validity.
 
         Args:
-            data (String): JSON representation of a Vesicle
+            data (String): JSON representation of a Vesicle or the dictionary
+                it decodes to
+            verify (Bool): Set False to skip checking the signature
 
         Returns:
             Vesicle: The newly read Vesicle object
 
         Raises:
-            ValueError: Unknown protocol version or malformed created timestamp
+            ValueError: Unknown protocol version, unknown encoding or malformed created timestamp
             KeyError: Missing key in vesicle JSON
             InvalidSignatureError: Does not match author_id's pubkey
             PersonaNotFoundError: Vesicle author not found
         """
 
-        msg = json.loads(data)
+        msg = json.loads(data) if isinstance(data, basestring) else data
 
         version, encoding = msg["enc"].split("-", 1)
         if version != VESICLE_VERSION:
             raise ValueError("Unknown protocol version: {} \nExpecting: {}".format(version, VESICLE_VERSION))
 
+        if encoding not in ENCODINGS:
+            raise ValueError("Unknown encoding: {} \nExpecting one of: {}".format(encoding, ", ".join(ENCODINGS)))
+
         try:
             vesicle = Vesicle(
                 id=msg["id"],
@@ -409,7 +676,32 @@ class Vesicle(db.Model):
             raise ValueError("Vesicle malformed: Error parsing date ({})".format(e))
 
         # Verify signature
-        if vesicle.signature is not None and not vesicle.signed():
+        if verify and vesicle.signature is not None and not vesicle.signed():
             raise InvalidSignatureError("Invalid signature on {}".format(vesicle))
 
         return vesicle
+
+
+def _insert_recipients(mapper, connection, target):
+    """Store the keycrypt of a new Vesicle in the vesicle_recipient table"""
+    keycrypt = target.get_keycrypt() if target.keycrypt else dict()
+    if keycrypt:
+        connection.execute(t_vesicle_recipients.insert(), [
+            {"vesicle_id": target.id, "persona_id": persona_id, "wrapped_key": wrapped_key}
+            for persona_id, wrapped_key in keycrypt.iteritems()])
+
+
+def _delete_recipients(mapper, connection, target):
+    """Remove the stored recipients of a Vesicle"""
+    connection.execute(t_vesicle_recipients.delete().where(t_vesicle_recipients.c.vesicle_id == target.id))
+
+
+def _update_recipients(mapper, connection, target):
+    """Replace the stored recipients of a Vesicle if its keycrypt has changed"""
+    if inspect(target).attrs.keycrypt.history.has_changes():
+        _delete_recipients(mapper, connection, target)
+        _insert_recipients(mapper, connection, target)
+
+event.listen(Vesicle, 'after_insert', _insert_recipients)
+event.listen(Vesicle, 'after_update', _update_recipients)
+event.listen(Vesicle, 'after_delete', _delete_recipients)
@@ -0,0 +1,156 @@
+import json
+import struct
+
+from base64 import b64encode, b64decode
+from binascii import Error as BinasciiError
+from collections import OrderedDict
+
+# Every binary Vesicle starts with these bytes
+MAGIC = "\x93SV1"
+
+# Field values are stored as UTF-8 text or, if this reproduces them exactly,
+# as the raw bytes of their hex or base64 encoding
+TEXT, HEX, B64, KEYCRYPT = range(4)
+
+# Vesicle attributes that have a field tag. All other attributes are stored
+# together in a JSON encoded extra field.
+FIELDS = ["id", "message_type", "enc", "author_id", "created", "souma_id",
+    "payload", "signature", "keycrypt"]
+EXTRA_FIELD = 63
+
+_FIELD_CODECS = {
+    "id": HEX,
+    "author_id": HEX,
+    "souma_id": HEX,
+    "payload": B64,
+    "signature": B64,
+    "keycrypt": KEYCRYPT
+}
+
+_header = struct.Struct(">BI")
+_entry_header = struct.Struct(">H")
+
+
+def _pack_keycrypt(keycrypt):
+    """Return keycrypt JSON as a sequence of raw recipient ids and wrapped keys"""
+    entries = json.loads(keycrypt, object_pairs_hook=OrderedDict)
+    parts = list()
+    for recipient_id, wrapped_key in entries.iteritems():
+        key_bytes = b64decode(wrapped_key)
+        parts.append(recipient_id.decode("hex"))
+        parts.append(_entry_header.pack(len(key_bytes)))
+        parts.append(key_bytes)
+    return "".join(parts)
+
+
+def _unpack_keycrypt(data):
+    """Return the keycrypt JSON for data created by _pack_keycrypt"""
+    entries = OrderedDict()
+    pos = 0
+    while pos < len(data):
+        recipient_id = data[pos:pos + 16].encode("hex")
+        length, = _entry_header.unpack_from(data, pos + 16)
+        pos += 16 + _entry_header.size
+        entries[recipient_id] = b64encode(data[pos:pos + length])
+        pos += length
+    if pos != len(data):
+        raise ValueError("Truncated keycrypt")
+    return json.dumps(entries)
+
+_pack = {
+    HEX: lambda value: value.decode("hex"),
+    B64: b64decode,
+    KEYCRYPT: _pack_keycrypt
+}
+
+_unpack = {
+    HEX: lambda data: data.encode("hex"),
+    B64: b64encode,
+    KEYCRYPT: _unpack_keycrypt
+}
+
+
+def _pack_field(name, value):
+    """Return codec and bytes of a field value, preferring the compact codec of the field"""
+    codec = _FIELD_CODECS.get(name, TEXT)
+    if codec != TEXT:
+        try:
+            data = _pack[codec](value)
+            if _unpack[codec](data) == value:
+                return (codec, data)
+        except (TypeError, ValueError, BinasciiError, struct.error):
+            pass
+    return (TEXT, value.encode("utf-8"))
+
+
+def encode(message):
+    """
+    Return the binary representation of a Vesicle message
+
+    Text attributes are stored length-prefixed. Encrypted payloads, signatures
+    and wrapped keys are stored as raw bytes instead of base64 encoded JSON
+    strings.
+
+    Args:
+        message (dict): Vesicle attributes as sent in Vesicle.json()
+
+    Returns:
+        String: Binary encoded message
+    """
+    parts = [MAGIC]
+    extra = dict()
+    for name, value in message.iteritems():
+        if name not in FIELDS or not isinstance(value, basestring):
+            extra[name] = value
+            continue
+
+        codec, data = _pack_field(name, value)
+        parts.append(_header.pack(FIELDS.index(name) << 2 | codec, len(data)))
+        parts.append(data)
+
+    if extra:
+        data = json.dumps(extra)
+        parts.append(_header.pack(EXTRA_FIELD << 2 | TEXT, len(data)))
+        parts.append(data)
+
+    return "".join(parts)
+
+
+def decode(data):
+    """
+    Return the Vesicle message contained in a binary representation
+
+    Args:
+        data (String): Binary encoded message as returned by encode()
+
+    Returns:
+        dict: Vesicle attributes as accepted by Vesicle.read()
+
+    Raises:
+        ValueError: If data is not a valid binary Vesicle
+    """
+    if not data.startswith(MAGIC):
+        raise ValueError("Not a binary Vesicle")
+
+    message = dict()
+    pos = len(MAGIC)
+    try:
+        while pos < len(data):
+            tag, length = _header.unpack_from(data, pos)
+            pos += _header.size
+            value = data[pos:pos + length]
+            if len(value) != length:
+                raise ValueError("Truncated field")
+            pos += length
+
+            field, codec = tag >> 2, tag & 3
+            if field == EXTRA_FIELD:
+                message.update(json.loads(value))
+            elif field < len(FIELDS):
+                message[FIELDS[field]] = value.decode("utf-8") if codec == TEXT else _unpack[codec](value)
+            else:
+                raise ValueError("Unknown field tag {}".format(tag))
+    except struct.error, e:
+        raise ValueError("Binary Vesicle malformed: {}".format(e))
+
+    return message
@@ -14,6 +14,7 @@ from gevent.event import Event
 from sqlalchemy.exc import OperationalError
 from uuid import uuid4
 
+from nucleus.crypto import crypto_executor, key_factory
 from nucleus.models import Souma, Starmap
 from nucleus.update import timed_update_check
 from nucleus.helpers import configure_app
@@ -149,10 +150,14 @@ if start:
             except Exception, e:
                 app.logger.error(e)
 
+        # Generate keys for new Personas in the background
+        key_factory.refill_async()
+
         # Update Souma
         if host_kind() in ["win", "osx"]:
             app.logger.info("Checking for updates")
             timed_update_check()
 
         shutdown.wait()
+        crypto_executor.shutdown()
         sys.exit()
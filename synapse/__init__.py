@@ -1,13 +1,19 @@
+import datetime
 import logging
 import json
+import keyczar
 
 from dateutil.parser import parse as dateutil_parse
+from gevent import Greenlet
 from uuid import uuid4
 
-from nucleus import create_session, notification_signals, PersonaNotFoundError, UnauthorizedError, VesicleStateError, CHANGE_TYPES
-from nucleus.models import Persona, Star, Planet, Starmap, Group, Oneup
-from nucleus.vesicle import Vesicle
+from nucleus import after_commit, commit_session, create_session, notification_signals, PersonaNotFoundError, UnauthorizedError, VesicleStateError, CHANGE_TYPES
+from nucleus.models import Persona, Star, Planet, Starmap, Group, Oneup, PendingObject, controlled_personas
+from nucleus.vesicle import Vesicle, decrypt_payload, verify_signature
+from synapse.dedupe import HandledVesicles
 from synapse.electrical import ElectricalSynapse
+from synapse.outbound import ObjectRequestCollector, OutboundCoalescer
+from synapse.pipeline import InboundPipeline, ReceivedVesicle
 from web_ui import app
 
 # These are Vesicle options which are recognized by this Synapse
@@ -39,6 +45,20 @@ class Synapse():
 
         # Core setup
         self.starmap = Starmap.query.get(app.config['SOUMA_ID'])
+        self.handled_vesicles = HandledVesicles(
+            capacity=app.config["VESICLE_FILTER_CAPACITY"],
+            error_rate=app.config["VESICLE_FILTER_ERROR_RATE"])
+
+        self.outbound = OutboundCoalescer(self._send_local_change,
+            window=app.config["OUTBOUND_COALESCE_WINDOW"])
+
+        self.object_requests = ObjectRequestCollector(self._send_object_requests,
+            window=app.config["OBJECT_REQUEST_WINDOW"],
+            batch_size=app.config["OBJECT_REQUEST_BATCH_SIZE"])
+
+        self.inbound = InboundPipeline(self,
+            workers=app.config["INBOUND_VESICLE_WORKERS"],
+            max_pending=app.config["INBOUND_VESICLE_QUEUE"])
 
         # Connect to glia
         self.electrical = ElectricalSynapse(parent=self)
@@ -46,6 +66,10 @@ class Synapse():
         # Connect to nucleus
         self._connect_signals()
 
+        # Repeat unanswered object requests
+        interval = app.config["PENDING_OBJECT_RETRY_INTERVAL"]
+        Greenlet(self.retry_pending_objects, interval).start_later(interval)
+
     def _connect_signals(self):
         """
         Connect to Blinker signals which are registered in nucleus.__init__
@@ -79,15 +103,14 @@ class Synapse():
             raise ValueError("Can't send Vesicle without defined author")
 
         if vesicle.encrypted():
-            keycrypt = json.loads(vesicle.keycrypt)
-
-            # First remove everyone from keycrypt that is not a current recipient
-            keycrypt = json.loads(vesicle.keycrypt)
-            remove_recipients = set(keycrypt.keys()) - set([r.id for r in recipients])
+            # First remove everyone from keycrypt that is not a current recipient.
+            # Work on a copy so the cached keycrypt always matches its serialization.
+            keycrypt = dict(vesicle.get_keycrypt())
+            remove_recipients = vesicle.stale_recipient_ids([r.id for r in recipients])
             for recipient_id in remove_recipients:
                 if recipient_id != vesicle.author_id:  # Don't remove author!
                     del keycrypt[recipient_id]
-            vesicle.keycrypt = json.dumps(keycrypt)
+            vesicle.set_keycrypt(keycrypt)
 
             # Then add the new recipients
             vesicle.add_recipients(recipients)
@@ -102,7 +125,7 @@ class Synapse():
             self.logger.info("{} was already signed".format(vesicle))
 
         if app.config["ENABLE_MYELIN"]:
-            self.electrical.myelin_store(vesicle)
+            self.electrical.myelin_enqueue(vesicle)
 
         return vesicle
 
@@ -164,17 +187,79 @@ class Synapse():
         call = getattr(self.logger, level)
         call("{msg}:\n{list}".format(msg=msg, list="\n* ".join(str(e) for e in errors)))
 
+    def _addressed(self, msg):
+        """Return True if a received Vesicle can be read by one of the controlled Personas
+
+        Plaintext Vesicles are addressed to everyone.
+
+        Args:
+            msg (dict): Decoded Vesicle JSON
+        """
+        try:
+            if msg.get("enc", "").split("-")[1:2] == ["plain"] or "keycrypt" not in msg:
+                return True
+
+            recipient_ids = json.loads(msg["keycrypt"]).keys()
+        except (ValueError, AttributeError, TypeError):
+            return False
+
+        return any(recipient_id in controlled_personas for recipient_id in recipient_ids)
+
+    def _handle_unaddressed_vesicle(self, msg):
+        """Drop or store a Vesicle none of the controlled Personas can read
+
+        Depending on the UNADDRESSED_VESICLE_POLICY setting the Vesicle is
+        either dropped or stored without checking its signature.
+
+        Args:
+            msg (dict): Decoded Vesicle JSON
+
+        Returns:
+            Vesicle: The stored Vesicle
+            None: If the Vesicle was dropped
+        """
+        if app.config["UNADDRESSED_VESICLE_POLICY"] != "store":
+            self.logger.debug("Dropped Vesicle [{}] not addressed to any controlled Persona".format(msg["id"][:6]))
+            return
+
+        try:
+            vesicle = Vesicle.read(msg, verify=False)
+        except (PersonaNotFoundError, KeyError, ValueError), e:
+            self.logger.info("Dropped Vesicle [{}] not addressed to any controlled Persona: {}".format(
+                msg["id"][:6], e))
+            return
+
+        old_vesicle = Vesicle.query.get(vesicle.id)
+        if old_vesicle is not None:
+            return old_vesicle
+
+        session = create_session()
+        try:
+            session.add(vesicle)
+            commit_session(session)
+        except:
+            session.rollback()
+            raise
+
+        self.logger.debug("Stored {} without verification: Not addressed to any controlled Persona".format(vesicle))
+        return vesicle
+
     def handle_object(self, vesicle, reader_persona, session):
         """
         Handle received object updates by verifying the request and calling
         an appropriate handler
 
+        Handled Vesicles only arrive here when they are re-applied (see
+        _reapply_dependents). Their insert changesets are applied to the
+        existing object like updates.
+
         Args:
             vesicle (Vesicle): Vesicle containing the object changeset
             reader_persona (Persona): Persona used for decrypting the Vesicle
         """
         # Validate response
         errors = list()
+        reapplied = vesicle.handled is True
 
         try:
             action = vesicle.data["action"]
@@ -193,136 +278,454 @@ class Synapse():
         if errors:
             self.logger.error("Malformed object received\n{}".format("\n".join(errors)))
         else:
+            if reapplied and action == "insert":
+                action = "update"
             handler = getattr(self, "object_{}".format(action))
             new_obj = handler(author, reader_persona, object_type, obj, session)
 
             if new_obj is not None:
                 vesicle.handled = True
-                new_obj.vesicles.append(vesicle)
+                if vesicle not in new_obj.vesicles:
+                    new_obj.vesicles.append(vesicle)
 
                 session.add(new_obj)
                 session.add(vesicle)
-                session.commit()
+                dependents = self._resolve_pending(object_type, new_obj, session)
+                commit_session(session)
+
+                if dependents:
+                    after_commit(lambda: self._reapply_dependents(dependents))
 
     def handle_object_request(self, vesicle, reader_persona, session):
         """
-        Act on received object requests by sending the object in question back
+        Act on received object requests by sending the objects in question back
+
+        The Vesicle either requests a single object with the keys `object_type`
+        and `object_id` or many objects with a list of such dictionaries in
+        the key `objects`. If the key `dependencies` is True, the direct
+        dependencies of every requested object that are authored by a
+        controlled Persona are sent before it (see _object_dependencies).
 
         Args:
-            vesicle (Vesicle): Vesicle containing metadata about the object
+            vesicle (Vesicle): Vesicle containing metadata about the objects
         """
+        if "objects" in vesicle.data:
+            requests = vesicle.data["objects"]
+        else:
+            requests = [vesicle.data, ]
+
+        dependencies = vesicle.data.get("dependencies") is True
+        recipient = vesicle.author
+
+        # Every object is sent only once per request
+        sent = set()
+        replies = list()
+        for request in requests:
+            obj = self._requested_object(request, recipient)
+            if obj is None:
+                continue
+
+            # Dependencies are sent first so they can be applied before obj,
+            # which would otherwise make the recipient request them again.
+            # Only dependencies of controlled authors can be re-encrypted for
+            # the recipient.
+            if dependencies:
+                for dep in self._object_dependencies(obj):
+                    if dep.id != recipient.id and (type(dep), dep.id) not in sent \
+                            and self._authored_here(dep) and self._published_to(dep, recipient):
+                        sent.add((type(dep), dep.id))
+                        replies.append(dep)
+
+            if (type(obj), obj.id) not in sent:
+                sent.add((type(obj), obj.id))
+                replies.append(obj)
 
-        # Validate vesicle
+        vesicle.handled = True
+        session.add(vesicle)
+        commit_session(session)
+
+        # Signing and encrypting the replies yields to other greenlets, which
+        # must not happen inside of a batch transaction
+        def send_replies():
+            for obj in replies:
+                try:
+                    self._send_object(obj, recipient)
+                except Exception, e:
+                    self.logger.error("Error sending {} to {}: {}".format(obj, recipient, e))
+        after_commit(send_replies)
+
+    def _requested_object(self, request, recipient):
+        """
+        Return the object requested in request if it may be sent to recipient
+
+        Args:
+            request (dict): Contains keys `object_type` and `object_id`
+            recipient (Persona): Author of the request
+
+        Returns:
+            Serializable: The requested object
+            None: If the request is invalid, the object was not found or it
+                is not published to recipient
+        """
+        # Validate request
         errors = []
         object_id = None
         object_type = None
 
         try:
-            object_id = vesicle.data["object_id"]
-            object_type = vesicle.data["object_type"]
-            recipient = vesicle.author
-        except KeyError, e:
-            errors.append("missing ({})".format(vesicle, e))
+            object_id = request["object_id"]
+            object_type = request["object_type"]
+        except (KeyError, TypeError), e:
+            errors.append("missing ({})".format(e))
 
         if object_type not in OBJECT_TYPES:
             errors.append("invalid object_type: {}".format(object_type))
 
         if errors:
             self._log_errors("Received invalid object request", errors)
+            return None
+
+        # Load object
+        obj_class = globals()[object_type]
+        obj = obj_class.query.get(object_id)
+
+        if obj is None:
+            self.logger.error("Requested object <{type} {id}> not found".format(
+                type=object_type, id=object_id[:6]))
+        elif not self._published_to(obj, recipient):
+            self.logger.info("Requested {} not published for request author {}".format(obj, recipient))
         else:
-            # Load object
-            obj_class = globals()[object_type]
-            obj = obj_class.query.get(object_id)
+            return obj
 
-            if obj is None:
-                self.logger.error("Requested object <{type} {id}> not found".format(
-                    type=object_type, id=object_id[:6]))
+    def _published_to(self, obj, recipient):
+        """
+        Return True if obj may be sent to recipient
 
-            elif hasattr(obj, "author") and recipient not in obj.author.contacts:
-                    self.logger.info("Requested {} not published for request author {}".format(obj, recipient))
-            elif isinstance(obj, Persona) and recipient not in obj.contacts:
-                    self.logger.info("Requested {} does not have requesting {} as a contact.".format(obj, recipient))
-            else:
-                for v in obj.vesicles:
-                    # Send response
-                    # Modified vesicles (re-encrypted) don't get saved to DB
-                    self._distribute_vesicle(v, recipients=[recipient, ])
-                self.logger.info("Sent {}'s {} vesicles to {}".format(
-                    obj, len(obj.vesicles), recipient
-                ))
+        Objects with an author are published to the author's contacts. Personas
+        are published to their own contacts.
 
-        vesicle.handled = True
-        session.add(vesicle)
-        session.commit()
+        Args:
+            obj (Serializable): Object to send
+            recipient (Persona): Persona to send obj to
+        """
+        if hasattr(obj, "author") and recipient not in obj.author.contacts:
+            return False
+        elif isinstance(obj, Persona) and recipient not in obj.contacts:
+            return False
+        return True
+
+    def _object_dependencies(self, obj):
+        """
+        Return the objects that are needed for inserting obj at a peer
+
+        These are the author, the parent Star and the authors of the Planets
+        of a Star, the author of a Starmap and the index and profile of a
+        Persona. Objects that are only available as a stub here are omitted.
+
+        Args:
+            obj (Serializable): A requested object
+
+        Returns:
+            list: Dependencies of obj
+        """
+        deps = list()
+        if isinstance(obj, Star):
+            deps.append(obj.author)
+            deps.append(obj.parent)
+            deps.extend(assoc.author for assoc in obj.planet_assocs)
+        elif isinstance(obj, Starmap):
+            deps.append(obj.author)
+        elif isinstance(obj, Persona):
+            deps.append(obj.index)
+            deps.append(obj.profile)
+
+        available = list()
+        for dep in deps:
+            if dep is None or type(dep).__name__ not in OBJECT_TYPES:
+                continue
+            elif getattr(dep, "_stub", False) is True:
+                continue
+            elif hasattr(dep, "get_state") and dep.get_state() == -1:
+                continue
+            available.append(dep)
+        return available
+
+    def _authored_here(self, obj):
+        """Return True if obj is authored by a Persona controlled by this Souma"""
+        author = obj if isinstance(obj, Persona) else getattr(obj, "author", None)
+        return author is not None and author.id in controlled_personas
+
+    def _send_object(self, obj, recipient):
+        """
+        Send obj to recipient as a snapshot or by replaying its Vesicles (see OBJECT_REQUEST_REPLY)
+
+        Args:
+            obj (Serializable): Object to send
+            recipient (Persona): Persona to send obj to
+        """
+        object_type = type(obj).__name__
+        if app.config["OBJECT_REQUEST_REPLY"] == "snapshot" and self._send_snapshot(obj, object_type, recipient):
+            self.logger.info("Sent snapshot of {} to {}".format(obj, recipient))
+        else:
+            for v in obj.vesicles:
+                # Send response
+                # Modified vesicles (re-encrypted) don't get saved to DB
+                self._distribute_vesicle(v, recipients=[recipient, ])
+            self.logger.info("Sent {}'s {} vesicles to {}".format(
+                obj, len(obj.vesicles), recipient
+            ))
+
+    def _send_snapshot(self, obj, object_type, recipient):
+        """
+        Send a single Vesicle containing the current state of obj
+
+        The snapshot is an insert of the object's full export including its
+        publishing state, signed by the object's author. Deleted objects are
+        sent as a delete instead, so they are not restored at the recipient.
+        It is only created for objects authored by a controlled Persona, as
+        other authors' objects can't be signed here. Snapshots are not stored
+        with the object's Vesicles.
+
+        Args:
+            obj (Serializable): The requested object
+            object_type (String): Capitalized class name of obj
+            recipient (Persona): Persona to send the snapshot to
+
+        Returns:
+            Boolean: True if the snapshot was sent
+        """
+        if not self._authored_here(obj):
+            return False
+        author = obj if isinstance(obj, Persona) else obj.author
+
+        if hasattr(obj, "get_state") and obj.state == -2:
+            action = "delete"
+            data = {"id": obj.id, "modified": obj.modified.isoformat()}
+        else:
+            action = "insert"
+            data = obj.export()
+            if hasattr(obj, "get_state"):
+                data["state"] = obj.state
+
+        vesicle = Vesicle(
+            id=uuid4().hex,
+            message_type="object",
+            data={
+                "action": action,
+                "object_type": object_type,
+                "object": data
+            },
+            author=author,
+            handled=True
+        )
+        # The snapshot is never flushed, which would set the author ID
+        vesicle.author_id = author.id
+        self._distribute_vesicle(vesicle, recipients=[recipient, ])
+        return True
 
     def handle_vesicle(self, data):
         """
         Parse received vesicles and call handler
 
         Args:
-            data (String): JSON encoded Vesicle
+            data (String): JSON encoded Vesicle or the dictionary it decodes to
 
         Returns:
             Vesicle: The Vesicle that was decrypted and loaded
             None: If no Vesicle could be loaded
         """
+        item = ReceivedVesicle(data)
+        self._parse_stage(item)
+        if not item.done:
+            self._crypto_stage(item)
+        if not item.done:
+            self._apply_stage(item)
+        return item.result
+
+    def _parse_stage(self, item, seen=None, defer_unknown=False):
+        """
+        Decode a received Vesicle and drop it if it doesn't need handling
+
+        Uses the database and must run in the greenlet that applies Vesicles.
+
+        Args:
+            item (ReceivedVesicle): The Vesicle being handled
+            seen (dict): (Optional) IDs of Vesicles received in the same batch
+                mapped to their ReceivedVesicle
+            defer_unknown (Bool): Mark Vesicles from unknown authors as deferred
+                instead of requesting the author from Glia
+        """
+        try:
+            msg = json.loads(item.data) if isinstance(item.data, basestring) else item.data
+            vesicle_id = msg["id"]
+        except (ValueError, KeyError, TypeError), e:
+            self.logger.error("Received malformed Vesicle: {}".format(e))
+            return item.finish(None)
+        item.vesicle_id = vesicle_id
+
+        # Drop Vesicles that were already handled before doing any crypto
+        known_vesicle = self.handled_vesicles.get(vesicle_id)
+        if known_vesicle is not None:
+            self.logger.debug("Dropped already handled {}".format(known_vesicle))
+            return item.finish(known_vesicle)
+
+        if seen is not None:
+            if seen.setdefault(vesicle_id, item) is not item:
+                item.duplicate_of = seen[vesicle_id]
+                return item.finish(None)
+
+        if not self._addressed(msg):
+            return item.finish(self._handle_unaddressed_vesicle(msg))
 
         try:
-            vesicle = Vesicle.read(data)
+            vesicle = Vesicle.read(msg, verify=False)
         except PersonaNotFoundError, e:
+            if defer_unknown:
+                item.deferred = True
+                return
+
             self.logger.info("Received Vesicle from unknown Persona, trying to retrieve Persona info.")
             resp, errors = self.electrical.persona_info(e[0])
             if errors:
                 self.logger.warning("Could not retrieve unknown Persona from server:\n{}".format(", ".join(errors)))
-                return
+                return item.finish(None)
             else:
-                vesicle = Vesicle.read(data)
+                vesicle = Vesicle.read(msg, verify=False)
+        except (KeyError, ValueError), e:
+            self.logger.error("Failed handling Vesicle due to decoding error: {}".format(e))
+            return item.finish(None)
+
+        item.msg = msg
+        item.vesicle = vesicle
+
+        # Continue with the stored copy of Vesicles that were received before
+        old_vesicle = Vesicle.query.get(vesicle.id)
+        if old_vesicle is not None:
+            item.vesicle = old_vesicle
+            item.stored = True
+
+        # Collect the keys and data needed by the crypto stage
+        vesicle = item.vesicle
+        if vesicle.signature is not None:
+            if vesicle.author is None:
+                self.logger.error("Dropped {}: Author not found".format(vesicle))
+                return item.finish(None)
+            item.signature_check = (vesicle.author.id, vesicle.author.sign_public, vesicle.payload, vesicle.signature)
+
+        self._collect_decryption(item)
+
+    def _collect_decryption(self, item):
+        """
+        Collect the keys and data needed for decrypting a Vesicle in the crypto stage
 
-        if vesicle is None:
-            self.logger.error("Failed handling Vesicle due to decoding error")
-        else:
-            old_vesicle = Vesicle.query.get(vesicle.id)
-            if old_vesicle is not None:
-                vesicle = old_vesicle
+        Args:
+            item (ReceivedVesicle): The Vesicle being handled
+        """
+        vesicle = item.vesicle
+        if vesicle.encrypted() and not vesicle.decrypted():
+            item.reader_persona = vesicle.find_reader()
+            if item.reader_persona is None:
+                self.logger.info("Not authorized to decrypt {}".format(vesicle))
+            else:
+                item.decryption = (item.reader_persona.id, item.reader_persona.crypt_private,
+                    vesicle.get_keycrypt()[item.reader_persona.id], vesicle.payload, vesicle.compressed())
 
-            # Vesicle is loaded and has not yet been handled, start processing..
-            session = create_session()
+    def _crypto_stage(self, item):
+        """
+        Verify the signature of a received Vesicle and decrypt its payload
 
-            # Decrypt if neccessary
-            import keyczar
-            if not vesicle.decrypted():
-                try:
-                    reader_persona = vesicle.decrypt()
-                except UnauthorizedError:
-                    self.logger.info("Not authorized to decrypt {}".format(vesicle))
-                except keyczar.errors.InvalidSignatureError:
-                    self.logger.warning("Failed decrypting {}: id={} h={}".format(vesicle, vesicle.id, vesicle._get_hashcode()))
-                    return vesicle
-
-            if old_vesicle is None:
-                session.add(vesicle)
-                session.commit()
+        Only uses the plain values collected by the parse stage, never the
+        database or the Vesicle object, so it can run concurrently for
+        multiple Vesicles. The apply stage stores the decrypted payload in
+        the Vesicle.
 
-            if not vesicle.decrypted():
-                self.logger.debug("{} has encrypted payload.".format(vesicle))
-            else:
-                self.logger.info("{} has payload:\n{}".format(vesicle, json.dumps(vesicle.data, indent=2)))
+        Args:
+            item (ReceivedVesicle): The Vesicle being handled
+        """
+        if item.signature_check is not None and not verify_signature(*item.signature_check):
+            self.logger.warning("Dropped Vesicle [{}]: Invalid signature".format(item.vesicle_id[:6]))
+            return item.finish(None)
 
-            # Call handler depending on message type
+        if item.decryption is not None:
             try:
-                if vesicle is not None and not vesicle.handled and vesicle.message_type in ALLOWED_MESSAGE_TYPES:
-                    handler = getattr(self, "handle_{}".format(vesicle.message_type))
-                    try:
-                        handler(vesicle, reader_persona, session)
-                    except UnauthorizedError, e:
-                        self.logger.error("Error handling {}: {}".format(vesicle, e))
-            except:
-                session.rollback()
-                raise
-            finally:
-                session.flush()
+                item.hashcode, item.plaintext = decrypt_payload(*item.decryption)
+            except keyczar.errors.InvalidSignatureError:
+                self.logger.warning("Failed decrypting Vesicle [{}]".format(item.vesicle_id[:6]))
+                return item.finish(item.vesicle)
 
-        return vesicle
+    def _lookup_stage(self, item):
+        """
+        Load the unknown Personas referred to by a decrypted Vesicle from Glia
+
+        Runs before the apply stage and outside of batch transactions, so that
+        handlers find these Personas in the database instead of contacting
+        Glia while holding the SQLite write lock.
+
+        Args:
+            item (ReceivedVesicle): The Vesicle being handled
+        """
+        if item.plaintext is None:
+            return
+
+        for persona_id in set(self._referenced_persona_ids(item.plaintext)):
+            if Persona.query.get(persona_id) is None:
+                self.electrical.get_persona(persona_id)
+
+    def _referenced_persona_ids(self, data):
+        """Return the values of all `author_id` keys in the decoded payload data"""
+        ids = list()
+        if isinstance(data, dict):
+            for k, v in data.iteritems():
+                if k == "author_id" and isinstance(v, basestring) and v != "None":
+                    ids.append(v)
+                else:
+                    ids.extend(self._referenced_persona_ids(v))
+        elif isinstance(data, list):
+            for v in data:
+                ids.extend(self._referenced_persona_ids(v))
+        return ids
+
+    def _apply_stage(self, item):
+        """
+        Store a received Vesicle and call the handler for its message type
+
+        Uses the database and must run in the greenlet that parsed the Vesicle.
+
+        Args:
+            item (ReceivedVesicle): The Vesicle being handled
+        """
+        vesicle = item.vesicle
+        item.result = vesicle
+
+        if item.plaintext is not None:
+            vesicle._hashcode = item.hashcode
+            vesicle.data = item.plaintext
+
+        session = create_session()
+
+        if not item.stored:
+            session.add(vesicle)
+            commit_session(session)
+
+        if not vesicle.decrypted():
+            self.logger.debug("{} has encrypted payload.".format(vesicle))
+            return
+        else:
+            self.logger.info("{} has payload:\n{}".format(vesicle, json.dumps(vesicle.data, indent=2)))
+
+        # Call handler depending on message type
+        try:
+            if (not vesicle.handled or item.reapply) and vesicle.message_type in ALLOWED_MESSAGE_TYPES:
+                handler = getattr(self, "handle_{}".format(vesicle.message_type))
+                try:
+                    handler(vesicle, item.reader_persona, session)
+                except UnauthorizedError, e:
+                    self.logger.error("Error handling {}: {}".format(vesicle, e))
+        except:
+            session.rollback()
+            raise
+        finally:
+            session.flush()
 
     def object_insert(self, author, recipient, object_type, obj, session):
         # Handle answer
@@ -344,7 +747,9 @@ class Synapse():
             if isinstance(o, Persona):
                 o.stub = False
             else:
-                o.set_state(0)
+                # Snapshots carry the publishing state of the object
+                state = int(obj.get("state", 0))
+                o.set_state(state if state >= 0 else 0)
             self.logger.info("Inserted new {}".format(o))
 
         return o
@@ -433,13 +838,16 @@ class Synapse():
             self.logger.info("Requesting profile of new contact {}".format(recipient))
             self.request_object("Persona", message["new_contact_id"], author, recipient, session)
 
-        session.commit()
+        commit_session(session)
 
     def on_local_model_change(self, sender, message):
         """
         React to model changes reported from the web-ui by transmitting
         appropriate messages to peers
 
+        Changes are buffered for OUTBOUND_COALESCE_WINDOW seconds, so that
+        successive changes to the same object are sent as one Vesicle.
+
         Args:
             sender(object): Sender of the Blinker signal
             message(dict): Changeset containing keys in CHANGESET_REQUIRED_FIELDS
@@ -461,6 +869,16 @@ class Synapse():
         if message["object_type"] not in OBJECT_TYPES:
             raise ValueError("Object type {} not supported".format(message["object_type"]))
 
+        self.outbound.add(message)
+
+    def _send_local_change(self, message):
+        """
+        Transmit a Vesicle with the current state of a locally changed object
+
+        Args:
+            message(dict): Changeset as passed to on_local_model_change, with
+                recipients replaced by their IDs in `recipient_ids`
+        """
         # Get the object's class from globals
         obj_class = globals()[message["object_type"]]
         obj = obj_class.query.get(message["object_id"])
@@ -487,8 +905,8 @@ class Synapse():
                 "modified": obj.modified.isoformat()
             }
 
-        if "recipients" in message:
-            recipients = message["recipients"]
+        if "recipient_ids" in message:
+            recipients = [Persona.query.get(r_id) for r_id in message["recipient_ids"]]
         else:
             recipients = author.contacts.all()
 
@@ -526,6 +944,8 @@ class Synapse():
                 id -- 32 byte object ID
                 author_id -- (optional) author of the request
                 recipient_id -- (optional) recipient of the request
+                dependent_type -- (optional) type of an object that refers to the requested object
+                dependent_id -- (optional) ID of that object
         """
         try:
             object_type = message["type"]
@@ -546,27 +966,49 @@ class Synapse():
         else:
             recipient = None
 
+        if "dependent_type" in message and "dependent_id" in message:
+            dependent = (message["dependent_type"], message["dependent_id"])
+        else:
+            dependent = None
+
         try:
-            self.request_object(object_type, object_id, author, recipient, session)
+            self.request_object(object_type, object_id, author, recipient, session, dependent=dependent)
         except:
             session.rollback()
             raise
         finally:
             session.flush()
 
-    def request_object(self, object_type, object_id, author, recipient, session):
+    def request_object(self, object_type, object_id, author, recipient, session, dependent=None):
         """
         Send a request for an object to a Persona
 
+        The request is recorded as a PendingObject until the object arrives.
+        Further requests for the object are suppressed until the previous
+        request has timed out (see PendingObject.due).
+
         Args:
             object_type (String): capitalized class name of the object
             object_id (String): 32 byte object ID
             author (Persona): Author of this request
             recipient (Persona): Persona to request this object from
+            dependent (tuple): (Optional) type and ID of an object that refers
+                to the requested object. It is refreshed when the object arrives.
 
         Raises:
             UnauthorizedError: If no source can be found that has one of the controlled Personas as a contact
         """
+        pending = PendingObject.query.get((object_type, object_id))
+        if pending is not None:
+            if dependent is not None:
+                pending.add_dependent(*dependent)
+                session.add(pending)
+
+            if not pending.due():
+                self.logger.debug("Not requesting <{} [{}]> again before {}".format(
+                    object_type, object_id[:6], pending.next_attempt()))
+                return
+
         obj_class = globals()[object_type]
         obj = obj_class.query.get(object_id)
 
@@ -589,24 +1031,150 @@ class Synapse():
             self.logger.info("Requesting <{object_type} {object_id}> as {author} from {source}".format(
                 object_type=object_type, object_id=object_id[:6], author=author, source=recipient))
 
-            data = {
-                "object_type": object_type,
-                "object_id": object_id
-            }
+            if pending is None:
+                pending = PendingObject(object_type=object_type, object_id=object_id, attempts=0)
+                if dependent is not None:
+                    pending.add_dependent(*dependent)
+            pending.author_id = author.id
+            pending.source_id = recipient.id
+            pending.requested_at = datetime.datetime.utcnow()
+            pending.attempts += 1
+            session.add(pending)
 
-            vesicle = Vesicle(
-                id=uuid4().hex,
-                message_type="object_request",
-                author=author,
-                data=data
-            )
-            session.add(vesicle)
-            session.commit()
-            session.refresh(vesicle)
+            self.object_requests.add(author.id, recipient.id, object_type, object_id)
 
-            vesicle = self._distribute_vesicle(vesicle, recipients=[recipient])
-            session.add(vesicle)
-            session.commit()
+    def retry_pending_objects(self, interval=None):
+        """
+        Request all pending objects again whose last request has timed out
+
+        Objects that have been requested OBJECT_REQUEST_MAX_ATTEMPTS times are
+        given up on.
+
+        Args:
+            interval (int): If set to an amount of seconds, the method will
+                repeatedly be called again in this interval
+        """
+        session = create_session()
+        for pending in PendingObject.query.all():
+            if not pending.due():
+                continue
+
+            if pending.attempts >= app.config["OBJECT_REQUEST_MAX_ATTEMPTS"]:
+                self.logger.warning("Giving up on {}".format(pending))
+                session.delete(pending)
+                continue
+
+            author = Persona.query.get(pending.author_id) if pending.author_id else None
+            source = Persona.query.get(pending.source_id) if pending.source_id else None
+            try:
+                self.request_object(pending.object_type, pending.object_id, author, source, session)
+            except UnauthorizedError, e:
+                self.logger.error("Could not retry request for {}: {}".format(pending, e))
+        commit_session(session)
+
+        # Schedule this method to be called in again in interval seconds
+        if interval is not None:
+            retry = Greenlet(self.retry_pending_objects, interval)
+            retry.start_later(interval)
+
+    def _resolve_pending(self, object_type, obj, session):
+        """
+        Remove the pending request for a received object
+
+        Args:
+            object_type (String): Capitalized class name of obj
+            obj (Serializable): The received object
+
+        Returns:
+            list: (type, id) tuples of the objects waiting for obj, which
+                should be re-applied once obj is committed (see
+                _reapply_dependents)
+        """
+        # Stubs are still missing their contents
+        if getattr(obj, "_stub", False) is True or (hasattr(obj, "get_state") and obj.get_state() == -1):
+            return list()
+
+        pending = PendingObject.query.get((object_type, obj.id))
+        if pending is None:
+            return list()
+
+        dependents = [d for d in pending.get_dependents() if d[0] in OBJECT_TYPES]
+        session.delete(pending)
+        self.logger.debug("{} arrived after {} requests, {} objects waiting".format(
+            obj, pending.attempts, len(dependents)))
+        return dependents
+
+    def _reapply_dependents(self, dependents):
+        """
+        Apply the latest Vesicle of objects that were waiting for a received object again
+
+        The changesets of the waiting objects can now refer to the received
+        object. The Vesicles pass through the apply stage of the inbound
+        pipeline again, so they are authorized and checked for being stale
+        like newly received Vesicles. Earlier Vesicles of the same object
+        would be rejected as stale and are skipped.
+
+        Decrypting the Vesicles yields to other greenlets, so this must not
+        run inside of a batch transaction.
+
+        Args:
+            dependents (list): (type, id) tuples of the waiting objects
+        """
+        vesicles = list()
+        for dependent_type, dependent_id in dependents:
+            dependent = globals()[dependent_type].query.get(dependent_id)
+            if dependent is None or (hasattr(dependent, "get_state") and dependent.state < 0):
+                continue
+
+            if len(dependent.vesicles) > 0:
+                vesicles.append(max(dependent.vesicles, key=lambda v: v.created))
+
+        self.inbound.reapply(vesicles)
+        self.logger.info("Re-applied {} Vesicles of waiting objects".format(len(vesicles)))
+
+    def _send_object_requests(self, author_id, recipient_id, requests):
+        """
+        Send one Vesicle requesting a number of objects
+
+        A single request is sent in the original object_request format, so
+        that it can be read by older Soumas.
+
+        Args:
+            author_id (String): ID of the requesting Persona
+            recipient_id (String): ID of the Persona to request the objects from
+            requests (list): (object type, object id) tuples
+        """
+        author = Persona.query.get(author_id)
+        recipient = Persona.query.get(recipient_id)
+
+        objects = [{"object_type": object_type, "object_id": object_id} for object_type, object_id in requests]
+        if len(objects) == 1:
+            data = objects[0]
+        else:
+            data = {"objects": objects}
+
+        if app.config["OBJECT_REQUEST_DEPENDENCIES"]:
+            data["dependencies"] = True
+
+        vesicle = Vesicle(
+            id=uuid4().hex,
+            message_type="object_request",
+            author=author,
+            data=data
+        )
+
+        session = create_session()
+        session.add(vesicle)
+        commit_session(session)
+        session.refresh(vesicle)
+
+        vesicle = self._distribute_vesicle(vesicle, recipients=[recipient])
+        session.add(vesicle)
+        commit_session(session)
 
     def shutdown(self):
+        self.outbound.shutdown()
+        self.object_requests.shutdown()
+        self.electrical.scheduler.shutdown()
+        self.electrical.outbox.shutdown()
         self.pool.kill()
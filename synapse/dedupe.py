@@ -0,0 +1,101 @@
+import math
+import struct
+import weakref
+
+from hashlib import sha256
+from sqlalchemy import event
+
+from nucleus.vesicle import Vesicle
+from web_ui import db
+
+
+class BloomFilter(object):
+    """Probabilistic set of strings that never reports false negatives
+
+    Args:
+        capacity (int): Number of elements the filter is sized for
+        error_rate (float): Probability of false positives at capacity
+    """
+
+    def __init__(self, capacity, error_rate=0.001):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.num_bits = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.num_hashes = max(1, int(round(math.log(2) * self.num_bits / capacity)))
+        self.count = 0
+        self._bits = bytearray((self.num_bits + 7) // 8)
+
+    def _positions(self, key):
+        """Yield the bit positions for key using double hashing"""
+        h1, h2 = struct.unpack(">QQ", sha256(key).digest()[:16])
+        for i in xrange(self.num_hashes):
+            yield (h1 + i * h2) % self.num_bits
+
+    def __contains__(self, key):
+        for pos in self._positions(key):
+            if not self._bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+    def add(self, key):
+        """Add key to the filter"""
+        for pos in self._positions(key):
+            self._bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+
+class HandledVesicles(object):
+    """Index of Vesicles that have already been stored and handled
+
+    A Bloom filter answers most lookups for unknown Vesicles without touching
+    the database. Positive answers are confirmed with a primary key lookup.
+
+    Args:
+        capacity (int): Expected number of handled Vesicles
+        error_rate (float): Acceptable rate of database lookups for unknown Vesicles
+    """
+
+    def __init__(self, capacity, error_rate=0.001):
+        self._filter = BloomFilter(capacity, error_rate)
+
+        for (vesicle_id,) in db.session.query(Vesicle.id).filter(Vesicle.handled == True):
+            self._filter.add(_filter_key(vesicle_id))
+
+        _indexes.add(self)
+
+    def get(self, vesicle_id):
+        """Return the stored Vesicle with vesicle_id if it has been handled
+
+        Args:
+            vesicle_id (String): ID of a received Vesicle
+
+        Returns:
+            Vesicle: The stored copy of the Vesicle
+            None: If the Vesicle has not been handled yet
+        """
+        if _filter_key(vesicle_id) not in self._filter:
+            return None
+        return Vesicle.query.filter_by(id=vesicle_id, handled=True).first()
+
+
+def _filter_key(vesicle_id):
+    """Return vesicle_id as a byte string for hashing"""
+    if isinstance(vesicle_id, unicode):
+        return vesicle_id.encode("utf-8")
+    return str(vesicle_id)
+
+
+# All live indexes are updated by the same mapper listeners, which are
+# registered only once
+_indexes = weakref.WeakSet()
+
+
+def _on_vesicle_written(mapper, connection, target):
+    """Add Vesicles to all indexes as soon as they are written as handled"""
+    if target.handled:
+        key = _filter_key(target.id)
+        for index in list(_indexes):
+            index._filter.add(key)
+
+event.listen(Vesicle, 'after_insert', _on_vesicle_written)
+event.listen(Vesicle, 'after_update', _on_vesicle_written)
@@ -5,21 +5,28 @@ import requests
 import iso8601
 import os
 
-from base64 import b64encode
+from base64 import b64encode, b64decode
 from Crypto import Random
 from dateutil.parser import parse as dateutil_parse
-from gevent import Greenlet
+from gevent.pool import Pool
 from hashlib import sha256
 from humanize import naturaltime
 from operator import itemgetter
 
-from nucleus import notification_signals, ERROR, create_session
-from nucleus.models import Persona, Souma
+from nucleus import notification_signals, wire, ERROR, commit_session, create_session, in_batch_transaction
+from nucleus.models import GliaSession, Persona, Souma
+from synapse.outbound import Outbox
+from synapse.poller import MyelinPoller
+from synapse.scheduler import Scheduler
 from web_ui import app
 
 API_VERSION = 0
 API_VERSION_LONG = 0.1
 
+# Vesicle encodings for Myelin transfers, in order of preference
+VESICLE_FORMATS = ["binary", "json"]
+VESICLE_CONTENT_TYPE = "application/x-souma-vesicle"
+
 
 class ElectricalSynapse(object):
     """
@@ -64,6 +71,27 @@ class ElectricalSynapse(object):
         self.session = requests.Session()  # Session object to use for requests
         self._peers = dict()
         self._sessions = dict()  # Holds session info for owned Personas (see _get_session(), _set_session()
+        self._session_jobs = set()  # IDs of Personas whose session jobs are running (see _start_session_jobs())
+        self._myelin_failures = dict()  # Failed attempts at handling Vesicles from Myelin by Vesicle ID
+        self.vesicle_format = "json"  # Encoding of Vesicles in Myelin transfers (see _negotiate_vesicle_format())
+        self.myelin_multi_recipient = False  # Glia can send the Myelin of many Personas at once (see _negotiate_vesicle_format())
+        self.myelin_long_poll = False  # Glia holds Myelin requests open until Vesicles arrive
+        self.session_multi_keepalive = False  # Glia can refresh many sessions in one request
+        self.scheduler = Scheduler()  # Runs keepalives, peer list updates and Myelin polls
+        self.scheduler.register("keepalive", self._keepalive_many, coalesce=app.config["KEEPALIVE_COALESCE"])
+        self.scheduler.register("peers", self._update_peer_lists, coalesce=app.config["PEER_LIST_COALESCE"])
+        self.poller = MyelinPoller(self, self.scheduler,
+            interval=app.config["MYELIN_POLLING_INTERVAL"],
+            max_interval=app.config["MYELIN_POLLING_MAX_INTERVAL"],
+            backoff=app.config["MYELIN_POLLING_BACKOFF"],
+            fast_interval=app.config["MYELIN_POLLING_FAST_INTERVAL"])
+        self.outbox = Outbox(self._myelin_upload,
+            max_count=app.config["MYELIN_STORE_BATCH_COUNT"],
+            max_bytes=app.config["MYELIN_STORE_BATCH_BYTES"],
+            max_age=app.config["MYELIN_STORE_BATCH_AGE"],
+            retry_delay=app.config["MYELIN_OUTBOX_RETRY_DELAY"],
+            max_backoff=app.config["MYELIN_OUTBOX_MAX_BACKOFF"],
+            poll_interval=app.config["MYELIN_OUTBOX_POLL_INTERVAL"])
         self.rng = Random.new()
 
         # Setup signals
@@ -102,6 +130,54 @@ class ElectricalSynapse(object):
         except KeyError, e:
             self.logger.warning("Received invalid server status: Missing {}".format(e))
 
+        self._negotiate_vesicle_format(server_info)
+
+        # Upload Vesicles queued before and after this point
+        self.outbox.start()
+
+    def _negotiate_vesicle_format(self, server_info):
+        """
+        Select the most compact Vesicle encoding supported by both Glia and this Souma
+
+        Glia servers list the encodings they accept in the `vesicle_formats`
+        field of their server status. Servers that don't have this field only
+        support JSON. Binary Vesicles are uploaded as the request body and
+        received as base64 encoded strings in the `vesicles` field of the
+        Myelin response.
+
+        Servers that can return the Myelin of many Personas in one response
+        set `myelin_multi_recipient` in their server status. Servers that
+        accept a `wait` parameter for holding Myelin requests open until
+        Vesicles arrive set `myelin_long_poll`. Servers that refresh a comma
+        separated list of session IDs in one keepalive request set
+        `session_multi_keepalive`.
+
+        Args:
+            server_info (dict): Response of the Glia root endpoint
+        """
+        try:
+            server_formats = server_info["server_status"][0].get("vesicle_formats", ["json"])
+        except (KeyError, IndexError, TypeError, AttributeError):
+            server_formats = ["json"]
+
+        try:
+            status = server_info["server_status"][0]
+            self.myelin_multi_recipient = status.get("myelin_multi_recipient", False) is True
+            self.myelin_long_poll = status.get("myelin_long_poll", False) is True \
+                and app.config["MYELIN_LONG_POLL_WAIT"] > 0
+            self.session_multi_keepalive = status.get("session_multi_keepalive", False) is True
+        except (KeyError, IndexError, TypeError, AttributeError):
+            self.myelin_multi_recipient = False
+            self.myelin_long_poll = False
+            self.session_multi_keepalive = False
+
+        local_formats = VESICLE_FORMATS if app.config["MYELIN_BINARY_VESICLES"] else ["json"]
+        for f in local_formats:
+            if f in server_formats:
+                self.vesicle_format = f
+                break
+        self.logger.info("Using {} encoding for Myelin Vesicles".format(self.vesicle_format))
+
     def _get_session(self, persona):
         """
         Return the current session id for persona or create a new session
@@ -123,14 +199,18 @@ class ElectricalSynapse(object):
         """
         Store a new session id for persona
 
+        Sessions are also stored in the database, so they can be reused after
+        a restart (see login_all()).
+
         Args:
             persona (persona)
             session_id (str): New session id. If set to none, the session is removed
             timeout (str): ISO formatted datetime of session timeout
         """
-
+        session = create_session()
         if session_id is None:
-            del self._sessions[persona.id]
+            self._sessions.pop(persona.id, None)
+            GliaSession.query.filter_by(persona_id=persona.id).delete()
         else:
             to = dateutil_parse(timeout)
 
@@ -138,6 +218,8 @@ class ElectricalSynapse(object):
                 'id': session_id,
                 'timeout': to
             }
+            session.merge(GliaSession(persona_id=persona.id, session_id=session_id, timeout=to))
+        commit_session(session)
 
     def _log_errors(self, msg, errors, level="error"):
         """
@@ -161,41 +243,116 @@ class ElectricalSynapse(object):
         """
         Keep @param persona's glia session alive by sending a keep-alive request
 
-        If there is no session yet for persona, she is logged in.
+        If the session is no longer valid, she is logged in again.
+        """
+        self._keepalive_many([persona.id, ])
+
+    def _keepalive_many(self, persona_ids):
+        """Refresh the Glia sessions of Personas and log in those whose sessions are invalid
+
+        Args:
+            persona_ids (list): IDs of the Personas
+        """
+        personas = [Persona.query.get(pid) for pid in persona_ids if pid in self._sessions]
+        valid, invalid = self._refresh_sessions([p for p in personas if p is not None])
+
+        # Sessions restored by login_all() whose first keepalive failed have no jobs yet
+        for persona in valid:
+            if persona.id not in self._session_jobs:
+                self._start_session_jobs(persona)
+
+        self._login_many(invalid)
+
+    def _refresh_sessions(self, personas):
+        """Send keepalives for the sessions of personas and schedule their next keepalives
+
+        If Glia supports it, all sessions are refreshed with one request.
+        Otherwise up to LOGIN_WORKERS keepalives are sent at the same time.
+        Keepalives that fail for other reasons than an invalid session are
+        retried after KEEPALIVE_RETRY_DELAY seconds.
+
+        Args:
+            personas (list): Personas that have a session
+
+        Returns:
+            tuple: List of Personas whose sessions were refreshed and list of
+                Personas whose sessions are no longer valid
         """
+        if len(personas) == 0:
+            return list(), list()
 
-        self.logger.info("Sending keepalive for {}".format(persona))
+        self.logger.info("Sending keepalive for {} personas".format(len(personas)))
+        if self.session_multi_keepalive and len(personas) > 1:
+            results = self._request_keepalives(personas)
+        else:
+            results = Pool(app.config["LOGIN_WORKERS"]).map(self._request_keepalive, personas)
+
+        valid = list()
+        invalid = list()
+        for persona, result in zip(personas, results):
+            if result:
+                self._set_session(persona, result['id'], result['timeout'])
+                self._queue_keepalive(persona)
+                valid.append(persona)
+            elif result is False:
+                self.logger.info("Session of {} is no longer valid".format(persona))
+                self._set_session(persona, None, None)
+                invalid.append(persona)
+            else:
+                self.scheduler.schedule("keepalive", persona.id, app.config["KEEPALIVE_RETRY_DELAY"])
+        return valid, invalid
+
+    def _request_keepalive(self, persona):
+        """Send a keepalive request for the session of persona
 
-        session_id = self._get_session(persona)["id"]
+        Returns:
+            dict: Session info with keys `id` and `timeout` if the session was
+                refreshed, False if it is invalid and None if the request failed
+        """
+        session_id = self._sessions[persona.id]['id']
         resp, errors = self._request_resource("GET", ["sessions", session_id])
 
         if errors:
             self._log_errors("Error requesting keepalive for {}".format(persona), errors)
+            if resp and "meta" in resp and \
+                    ERROR["INVALID_SESSION"][0] in map(itemgetter(0), resp["meta"].get("errors", [])):
+                return False
+            return None
+        return resp['sessions'][0]
 
-            # Login if session is invalid
-            if ERROR["INVALID_SESSION"] in resp['meta']['errors']:
-                self.login(persona)
-        else:
-            session_id = resp['sessions'][0]['id']
-            timeout = resp['sessions'][0]['timeout']
-            self._set_session(persona, session_id, timeout)
+    def _request_keepalives(self, personas):
+        """Send one keepalive request for the sessions of all personas
+
+        Sessions missing from the response are invalid.
+
+        Returns:
+            list: Result of _request_keepalive() for each Persona
+        """
+        session_ids = [self._sessions[p.id]['id'] for p in personas]
+        resp, errors = self._request_resource("GET", ["sessions", ",".join(session_ids)])
 
-            self._queue_keepalive(persona)
+        if errors:
+            self._log_errors("Error requesting keepalive for {} personas".format(len(personas)), errors)
+            return [None] * len(personas)
+
+        sessions = dict((s['id'], s) for s in resp['sessions'])
+        return [sessions.get(session_id, False) for session_id in session_ids]
 
     def _queue_keepalive(self, persona, timeout=900):
         """
-        Queue keepalive for persona in @param timeout seconds (default 15 minutes)
+        Schedule keepalive for persona shortly before her session times out
+
+        Scheduling a keepalive replaces the one already scheduled for persona.
         """
 
         buf = 10  # seconds
-        remaining = (self._get_session(persona)['timeout'] - datetime.datetime.utcnow()).seconds - buf
+        remaining = int((self._get_session(persona)['timeout'] - datetime.datetime.utcnow()).total_seconds()) - buf
         if (remaining - buf) < 0:
             remaining = 2
 
         self.logger.debug("Next keepalive for {} queued in {} seconds".format(persona, remaining))
 
-        ping = Greenlet(self._keepalive, persona)
-        ping.start_later(remaining)
+        self.scheduler.schedule("keepalive", persona.id, remaining)
 
     def _glia_auth(self, url, payload=None):
         """Returns headers with HTTP Glia Authentication for given request data
@@ -228,7 +385,8 @@ class ElectricalSynapse(object):
             method (str): One of "GET", "POST", "PUT", "PATCH", "DELETE"
             endpoint (list): A list of strings forming the path of the API endpoint
             params (dict): Optional parameters to attach to the query strings
-            payload (object): Will be attached to the request JSON encoded
+            payload (object): Will be attached to the request JSON encoded. Strings
+                are attached as they are, using the binary Vesicle content type.
 
         Returns:
             A tuple of two elements:
@@ -242,7 +400,11 @@ class ElectricalSynapse(object):
         if method not in HTTP_METHODS_1 and method not in HTTP_METHODS_2:
             raise ValueError("Invalid request method {}".form(method))
 
-        if payload:
+        content_type = "application/json"
+        if isinstance(payload, str):
+            payload_json = payload
+            content_type = VESICLE_CONTENT_TYPE
+        elif payload:
             if not isinstance(payload, dict):
                 raise ValueError("Payload must be a dictionary type")
             try:
@@ -274,8 +436,11 @@ class ElectricalSynapse(object):
 
                 r = call(url, headers=headers, params=params, verify=cert)
             else:
-                self.logger.debug("{} {}\n{}".format(method, url, payload_json))
-                headers['Content-Type'] = "application/json"
+                if content_type == "application/json":
+                    self.logger.debug("{} {}\n{}".format(method, url, payload_json))
+                else:
+                    self.logger.debug("{} {} ({} bytes {})".format(method, url, len(payload_json), content_type))
+                headers['Content-Type'] = content_type
                 r = call(url, payload_json, headers=headers, params=params, verify=cert)
             r.raise_for_status()
         except requests.exceptions.RequestException, e:
@@ -306,7 +471,9 @@ class ElectricalSynapse(object):
         # Log all errors
         if errors:
             self.logger.error("{} {} / {} failed.\nParam: {}\nPayload: {}\nErrors:\n* {}".format(
-                method, endpoint, url, params, payload_json, "\n* ".join(str(e) for e in errors)))
+                method, endpoint, url, params,
+                payload_json if content_type == "application/json" else "{} bytes".format(len(payload_json)),
+                "\n* ".join(str(e) for e in errors)))
 
         return (resp, error_strings)
 
@@ -320,20 +487,39 @@ class ElectricalSynapse(object):
         Returns:
             list A list of error messages or None
         """
+        return self._update_peer_lists([persona.id, ])
 
-        self.logger.info("Updating peerlist for {}".format(persona))
+    def _update_peer_lists(self, persona_ids):
+        """
+        Retrieve current IPs of the peers of many Personas with one request
 
-        contacts = Persona.query.get(persona.id).contacts
+        Schedules the next update of each Persona's peer list after
+        PEER_LIST_INTERVAL seconds.
 
-        peer_ids = list()  # peers we want to look up
-        for p in contacts:
-            peer_ids.append(p.id)
+        Args:
+            persona_ids (list): IDs of the Personas whose peers will be located
 
-        if len(peer_ids) == 0:
-            self.logger.info("{} has no peers. Peerlist update cancelled.".format(persona))
+        Returns:
+            list A list of error messages or None
+        """
+        contacts = dict()
+        for persona_id in persona_ids:
+            persona = Persona.query.get(persona_id)
+            if persona is None:
+                continue
+
+            self.logger.info("Updating peerlist for {}".format(persona))
+            for p in persona.contacts:
+                contacts[p.id] = p
+
+            if persona_id in self._sessions:
+                self.scheduler.schedule("peers", persona_id, app.config["PEER_LIST_INTERVAL"])
+
+        if len(contacts) == 0:
+            self.logger.info("No peers to look up. Peerlist update cancelled.")
         else:
             # ask glia server for peer info
-            resp, errors = self._request_resource("GET", ["sessions"], params={'ids': ",".join(peer_ids)})
+            resp, errors = self._request_resource("GET", ["sessions"], params={'ids': ",".join(contacts.keys())})
             # TODO: Remove peers that are no longer online
 
             if errors:
@@ -360,6 +546,10 @@ class ElectricalSynapse(object):
     def get_persona(self, persona_id):
         """Returns a Persona object for persona_id, loading it from Glia if neccessary
 
+        Glia is not contacted inside of a batch transaction, which must not
+        wait for requests (see nucleus.batch_transaction). Personas needed for
+        applying received Vesicles are loaded before (see Synapse._lookup_stage).
+
         Args:
             persona_id (String): ID of the required Persona
 
@@ -371,6 +561,10 @@ class ElectricalSynapse(object):
 
         if persona:
             return persona
+        elif in_batch_transaction():
+            self.logger.warning("Not requesting unknown Persona [{}] inside of a batch transaction".format(
+                persona_id[:6]))
+            return None
         else:
             resp, errors = self.persona_info(persona_id)
 
@@ -413,29 +607,115 @@ class ElectricalSynapse(object):
     def login_all(self):
         """
         Login all personas with a non-empty private key
+
+        Unexpired sessions stored by an earlier run are reused if Glia
+        confirms them in a keepalive. All other personas are logged in
+        concurrently by up to LOGIN_WORKERS greenlets.
         """
         persona_set = Persona.query.filter('sign_private != ""').all()
         if len(persona_set) == 0:
             self.logger.warning("No controlled Persona found.")
         else:
-            self.logger.info("Logging in {} personas".format(len(persona_set)))
-            for p in persona_set:
-                self.persona_login(p)
+            restored = self._refresh_sessions(self._restore_sessions(persona_set))[0]
+            for p in restored:
+                self._start_session_jobs(p)
+
+            logins = [p for p in persona_set if p.id not in self._sessions]
+            self.logger.info("Reused {} sessions, logging in {} personas".format(len(restored), len(logins)))
+            self._login_many(logins)
+
+    def _restore_sessions(self, personas):
+        """Load the unexpired sessions of personas stored by an earlier run
 
-    def myelin_receive(self, recipient_id, interval=None):
+        Expired sessions are removed from the database.
+
+        Args:
+            personas (list): Personas to load sessions for
+
+        Returns:
+            list: Personas whose sessions were loaded
+        """
+        session = create_session()
+        now = datetime.datetime.utcnow()
+        GliaSession.query.filter(GliaSession.timeout <= now).delete()
+        commit_session(session)
+
+        stored = dict((s.persona_id, s) for s in GliaSession.query.filter(
+            GliaSession.persona_id.in_([p.id for p in personas])))
+
+        restored = list()
+        for persona in personas:
+            if persona.id in stored and persona.id not in self._sessions:
+                self._sessions[persona.id] = {
+                    'id': stored[persona.id].session_id,
+                    'timeout': stored[persona.id].timeout
+                }
+                restored.append(persona)
+        return restored
+
+    def _login_many(self, personas):
+        """Login personas, running up to LOGIN_WORKERS logins at the same time"""
+        if personas:
+            Pool(app.config["LOGIN_WORKERS"]).map(self.persona_login, personas)
+
+    def _start_session_jobs(self, persona):
+        """Schedule keepalives, peer list updates and Myelin polls for a logged in persona"""
+        self._session_jobs.add(persona.id)
+        self._queue_keepalive(persona)
+        self.scheduler.schedule("peers", persona.id, 0)
+        if app.config["ENABLE_MYELIN"]:
+            self.poller.add(persona.id)
+
+    def myelin_receive(self, recipient_id):
         """
         Request Vesicles directed at recipient from Myelin and pass them on to Synapse for handling.
 
         Parameters:
             recipient_id (String) The ID of the Persona for which to listen
-            interval (int) If set to an amount of seconds, the function will repeatedly be called again in this interval
         """
-        recipient = Persona.query.get(recipient_id)
-        if not recipient:
-            self.logger.error("Could not find Persona {}".format(recipient_id))
-            return
+        self.myelin_receive_many([recipient_id, ])
+
+    def myelin_receive_many(self, recipient_ids):
+        """
+        Request Vesicles directed at a number of recipients from Myelin and handle them
+
+        If Glia supports it, the Myelin of all recipients is requested at once.
+        Otherwise up to MYELIN_POLL_WORKERS requests run concurrently. Received
+        Vesicles are handled one recipient after another.
+
+        Args:
+            recipient_ids (list): IDs of the Personas for which to listen
+
+        Returns:
+            dict: Number of received Vesicles for each recipient ID, None for
+                recipients whose Myelin could not be retrieved
+        """
+        recipients = list()
+        for recipient_id in recipient_ids:
+            recipient = Persona.query.get(recipient_id)
+            if recipient is None:
+                self.logger.error("Could not find Persona {}".format(recipient_id))
+            else:
+                recipients.append(recipient)
+
+        if len(recipients) > 1 and self.myelin_multi_recipient:
+            responses = self._myelin_fetch_many(recipients)
+        else:
+            pool = Pool(app.config["MYELIN_POLL_WORKERS"])
+            responses = pool.map(self._myelin_fetch, recipients)
+
+        received = dict()
+        for recipient, resp in zip(recipients, responses):
+            if resp is None:
+                received[recipient.id] = None
+                continue
+
+            received[recipient.id] = len(resp["vesicles"])
+            self._handle_myelin_response(recipient, resp)
+        return received
 
-        self.logger.debug("Updating Myelin of {} at {} second intervals".format(recipient, interval))
+    def _myelin_params(self, recipient):
+        """Return the query parameters for requesting recipient's Myelin"""
         params = dict()
 
         # Determine offset
@@ -445,32 +725,131 @@ class ElectricalSynapse(object):
                 recipient, naturaltime(datetime.datetime.utcnow() - offset), offset))
             params["offset"] = str(recipient.myelin_offset)
 
-        resp, errors = self._request_resource("GET", ["myelin", "recipient", recipient.id], params, None)
+        if self.vesicle_format != "json":
+            params["format"] = self.vesicle_format
+
+        if self.myelin_long_poll:
+            params["wait"] = app.config["MYELIN_LONG_POLL_WAIT"]
+
+        return params
+
+    def _myelin_fetch(self, recipient):
+        """
+        Request the Myelin of a single recipient
+
+        Args:
+            recipient (Persona): The Persona whose Myelin is requested
+
+        Returns:
+            dict: Myelin response
+            None: If an error occurred
+        """
+        self.logger.debug("Updating Myelin of {}".format(recipient))
+        resp, errors = self._request_resource("GET", ["myelin", "recipient", recipient.id],
+            self._myelin_params(recipient), None)
 
         if errors:
             self._log_errors("Error receiving from Myelin", errors)
-        else:
-            for v in resp["vesicles"]:
-                vesicle = self.synapse.handle_vesicle(v)
-                if vesicle is not None:
-                    myelin_modified = iso8601.parse_date(
-                        resp["meta"]["myelin_modified"][vesicle.id]).replace(tzinfo=None)
-                    if offset is None or myelin_modified > offset:
-                        offset = myelin_modified
-
-        # Update recipient's offset if a more recent Vesicle has been received
-        if offset is not None:
-            if recipient.myelin_offset is None or offset > recipient.myelin_offset:
-                recipient.myelin_offset = offset
+            return None
+        return resp
+
+    def _myelin_fetch_many(self, recipients):
+        """
+        Request the Myelin of a number of recipients using a single request
+
+        Glia answers with the Myelin response of every recipient in the
+        `recipients` field, keyed by recipient ID.
+
+        Args:
+            recipients (list): The Personas whose Myelin is requested
+
+        Returns:
+            list: Myelin response or None for each recipient
+        """
+        self.logger.debug("Updating Myelin of {} Personas".format(len(recipients)))
+        params = {
+            "ids": ",".join(r.id for r in recipients),
+            "offsets": ",".join(self._myelin_params(r).get("offset", "") for r in recipients)
+        }
+        if self.vesicle_format != "json":
+            params["format"] = self.vesicle_format
+
+        if self.myelin_long_poll:
+            params["wait"] = app.config["MYELIN_LONG_POLL_WAIT"]
+
+        resp, errors = self._request_resource("GET", ["myelin", "recipients"], params, None)
+
+        if errors:
+            self._log_errors("Error receiving from Myelin", errors)
+            return [None for r in recipients]
+        return [resp["recipients"].get(r.id) for r in recipients]
+
+    def _handle_myelin_response(self, recipient, resp):
+        """
+        Handle the Vesicles received from Myelin for recipient and advance its Myelin offset
+
+        The offset is committed in the same transaction as the Vesicles it
+        covers. It is only advanced up to the first Vesicle whose handling
+        failed, so that Vesicle is received again with the next poll. After
+        MYELIN_VESICLE_MAX_ATTEMPTS failures the Vesicle is skipped.
+
+        Args:
+            recipient (Persona): The Persona whose Myelin was requested
+            resp (dict): Myelin response
+        """
+        messages = list()
+        for v in resp["vesicles"]:
+            if resp.get("format", "json") == "binary":
+                try:
+                    v = wire.decode(b64decode(v))
+                except (TypeError, ValueError), e:
+                    self.logger.error("Received malformed binary Vesicle: {}".format(e))
+                    continue
+            messages.append(v)
+
+        myelin_modified = resp["meta"]["myelin_modified"]
+        progress = {"offset": recipient.myelin_offset, "blocked": False}
+
+        def checkpoint(items):
+            """Advance recipient's offset past the Vesicles in items that have been handled in sequence"""
+            for item in items:
+                if progress["blocked"]:
+                    break
+                elif item.failed and item.vesicle_id is not None and self._retry_myelin_vesicle(item.vesicle_id):
+                    progress["blocked"] = True
+                    break
+                self._myelin_failures.pop(item.vesicle_id, None)
+
+                if item.vesicle_id in myelin_modified:
+                    modified = iso8601.parse_date(myelin_modified[item.vesicle_id]).replace(tzinfo=None)
+                    if progress["offset"] is None or modified > progress["offset"]:
+                        progress["offset"] = modified
+
+            if progress["offset"] is not None and (recipient.myelin_offset is None or
+                    progress["offset"] > recipient.myelin_offset):
+                recipient.myelin_offset = progress["offset"]
                 session = create_session()
                 session.add(recipient)
-                session.commit()
-                # session.close()
+                commit_session(session)
+
+        self.synapse.inbound.process(messages,
+            batch=app.config["MYELIN_BATCH_TRANSACTIONS"], checkpoint=checkpoint)
+
+    def _retry_myelin_vesicle(self, vesicle_id):
+        """Record a failed attempt at handling a Vesicle from Myelin
 
-        # Schedule this method to be called in again in interval seconds
-        if interval is not None:
-            update = Greenlet(self.myelin_receive, recipient_id, interval)
-            update.start_later(interval)
+        Returns:
+            Boolean: True if the Vesicle should be received again
+        """
+        attempts = self._myelin_failures.get(vesicle_id, 0) + 1
+        if attempts >= app.config["MYELIN_VESICLE_MAX_ATTEMPTS"]:
+            self.logger.error("Giving up on Vesicle [{}] after {} failed attempts".format(vesicle_id[:6], attempts))
+            self._myelin_failures.pop(vesicle_id, None)
+            return False
+
+        self.logger.warning("Handling Vesicle [{}] failed, receiving it again".format(vesicle_id[:6]))
+        self._myelin_failures[vesicle_id] = attempts
+        return True
 
     def myelin_store(self, vesicle):
         """
@@ -482,20 +861,70 @@ class ElectricalSynapse(object):
         Returns:
             list List of error strings if such occurred
         """
-        data = {
-            "vesicles": [vesicle.json(), ]
-        }
+        return self._myelin_upload([(vesicle.id, vesicle.json()), ])
+
+    def myelin_store_many(self, vesicles):
+        """
+        Store a number of Vesicles in Myelin using a single request
+
+        Parameters:
+            vesicles (list) The Vesicles to be stored
+
+        Returns:
+            list List of error strings if such occurred
+        """
+        return self._myelin_upload([(v.id, v.json()) for v in vesicles])
+
+    def myelin_enqueue(self, vesicle):
+        """
+        Queue a Vesicle for storing it in Myelin in the background (see Outbox)
+
+        Parameters:
+            vesicle (Vesicle) The vesicle to be stored
+        """
+        self.outbox.add(vesicle)
+
+    def _myelin_upload(self, vesicles):
+        """
+        Upload serialized Vesicles to Myelin
 
-        resp, errors = self._request_resource("PUT", ["myelin", "vesicles", vesicle.id], payload=data)
+        A single Vesicle is stored at its own Myelin resource, using the binary
+        encoding if negotiated with Glia. Multiple Vesicles are stored at the
+        Myelin collection in one JSON encoded request, as the binary encoding
+        holds only one Vesicle per request body.
+
+        Args:
+            vesicles (list): (Vesicle id, JSON) tuples as stored in the Outbox
+
+        Returns:
+            list: List of error strings if such occurred
+        """
+        if len(vesicles) == 0:
+            return
+        elif len(vesicles) == 1:
+            vesicle_id, vesicle_json = vesicles[0]
+            endpoint = ["myelin", "vesicles", vesicle_id]
+            if self.vesicle_format == "binary":
+                data = wire.encode(json.loads(vesicle_json))
+            else:
+                data = {"vesicles": [vesicle_json, ]}
+        else:
+            endpoint = ["myelin", "vesicles"]
+            data = {"vesicles": [vesicle_json for vesicle_id, vesicle_json in vesicles]}
+
+        resp, errors = self._request_resource("PUT", endpoint, payload=data)
 
         if errors:
-            self._log_errors("Error transmitting {} to Myelin".format(vesicle), errors)
+            self._log_errors("Error transmitting {} Vesicles to Myelin".format(len(vesicles)), errors)
             return errors
         else:
-            self.logger.debug("Transmitted {} to Myelin".format(vesicle))
+            self.logger.debug("Transmitted {} Vesicles to Myelin".format(len(vesicles)))
 
     def on_local_model_changed(self, sender, message):
         """Check if Personas were changed and call register / unregister method"""
+        # Replies to local changes are likely
+        self.poller.activity(message.get("author_id"))
+
         if message["object_type"] == "Persona":
             persona = Persona.query.get(message["object_id"])
 
@@ -540,7 +969,7 @@ class ElectricalSynapse(object):
                         crypt_public=pinfo["crypt_public"]
                     )
                     session.add(p)
-                    session.commit()
+                    commit_session(session)
                     self.logger.info("Loaded {} from Glia server".format(p))
                 except KeyError, e:
                     self.logger.warning("Missing key in server response for storing new Persona: {}".format(e))
@@ -562,11 +991,12 @@ class ElectricalSynapse(object):
         Login a persona on the server, register if not existing. Start myelinated reception if activated.
 
         Returns:
-            str -- new session id
+            dict -- the session of persona with keys `id` and `timeout` (see
+                _get_session()), None if login failed
         """
         # Check current state
         if persona.id in self._sessions:
-            return self._get_session(persona)["session_id"]
+            return self._sessions[persona.id]
 
         # Obtain auth token
         info, errors = self._request_resource("GET", ["personas", persona.id])
@@ -581,8 +1011,7 @@ class ElectricalSynapse(object):
                     self.logger.error("Failed logging in / registering {}.".format(persona))
                     return None
                 else:
-                    session = self._get_session(persona)
-                    return session["id"]
+                    return self._get_session(persona)
         try:
             auth = info["personas"][0]["auth"]
         except KeyError, e:
@@ -609,15 +1038,9 @@ class ElectricalSynapse(object):
 
             self.logger.info("Persona {} logged in until {}".format(persona, timeout))
             self._set_session(persona, session_id, timeout)
-            self._queue_keepalive(persona)
-            self._update_peer_list(persona)
-            if app.config["ENABLE_MYELIN"]:
-                self.myelin_receive(persona.id, interval=app.config["MYELIN_POLLING_INTERVAL"])
-
-            return {
-                "id": session_id,
-                "timeout": timeout
-            }
+            self._start_session_jobs(persona)
+
+            return self._sessions[persona.id]
 
     def persona_logout(self, persona):
         """
@@ -638,6 +1061,9 @@ class ElectricalSynapse(object):
             return errors
         else:
             self._set_session(persona, None, None)
+            self._session_jobs.discard(persona.id)
+            self.poller.remove(persona.id)
+            self.scheduler.cancel_all(persona.id)
             self.logger.info("Logged out {}".format(persona))
 
     def persona_register(self, persona):
@@ -678,10 +1104,7 @@ class ElectricalSynapse(object):
 
         self.logger.info("Registered {} with server.".format(persona))
         self._set_session(persona, session_id, timeout)
-        self._update_peer_list(persona)
-        self._queue_keepalive(persona)
-        if app.config["ENABLE_MYELIN"]:
-            self.myelin_receive(persona.id, interval=app.config["MYELIN_POLLING_INTERVAL"])
+        self._start_session_jobs(persona)
 
     def persona_unregister(self, persona):
         """
@@ -0,0 +1,345 @@
+import datetime
+import hashlib
+import logging
+import random
+import time
+
+from collections import OrderedDict
+from gevent import spawn, spawn_later
+from gevent.event import Event
+
+from nucleus import after_commit, commit_session, create_session
+from nucleus.models import OutboxVesicle
+from web_ui import app
+
+# Action that results from a buffered action followed by another action on the same object
+MERGED_ACTIONS = {
+    ("insert", "insert"): "insert",
+    ("insert", "update"): "insert",
+    ("insert", "delete"): "delete",
+    ("update", "insert"): "insert",
+    ("update", "update"): "update",
+    ("update", "delete"): "delete",
+    ("delete", "insert"): "insert",
+    ("delete", "update"): "delete",
+    ("delete", "delete"): "delete",
+}
+
+
+class OutboundCoalescer(object):
+    """Buffers local model changes and merges changes to the same object
+
+    Changes are collected for `window` seconds after the first one arrived.
+    All changes to an object by the same author for the same recipients are
+    merged into a single change, which is then passed to `send`. Objects are
+    exported when they are sent, so a merged change always carries their
+    latest state.
+
+    Args:
+        send (function): Called with every merged change message
+        window (float): Seconds to collect changes for. Changes are sent
+            right away if this is 0.
+    """
+
+    def __init__(self, send, window=0.5):
+        self.send = send
+        self.window = window
+        self.logger = logging.getLogger('synapse')
+        self.logger.setLevel(app.config['LOG_LEVEL'])
+        self._changes = OrderedDict()
+        self._flush = None
+
+    def __len__(self):
+        return len(self._changes)
+
+    def add(self, message):
+        """Buffer a change message for sending
+
+        Args:
+            message (dict): Change message as passed to Synapse.on_local_model_change.
+                Recipients are stored by ID and loaded again when sending.
+        """
+        message = dict(message)
+        if "recipients" in message:
+            message["recipient_ids"] = sorted(set(r.id for r in message.pop("recipients")))
+
+        if self.window <= 0:
+            self.send(message)
+            return
+
+        key = (message["object_type"], message["object_id"], message["author_id"],
+            tuple(message.get("recipient_ids", ())) or None)
+
+        buffered = self._changes.get(key)
+        if buffered is not None:
+            message["action"] = MERGED_ACTIONS[(buffered["action"], message["action"])]
+            self.logger.debug("Merged {} of <{} [{}]> into buffered {}".format(
+                message["action"], message["object_type"], message["object_id"][:6], buffered["action"]))
+            buffered.update(message)
+        else:
+            self._changes[key] = message
+
+        if self._flush is None:
+            self._flush = spawn_later(self.window, self.flush)
+
+    def flush(self):
+        """Send all buffered changes in the order their objects were first changed"""
+        self._flush = None
+        changes = self._changes
+        self._changes = OrderedDict()
+
+        if changes:
+            self.logger.debug("Sending {} buffered changes".format(len(changes)))
+
+        for message in changes.itervalues():
+            try:
+                self.send(message)
+            except Exception, e:
+                self.logger.error("Error sending change of <{} [{}]>: {}".format(
+                    message["object_type"], message["object_id"][:6], e))
+
+    def shutdown(self):
+        """Send buffered changes right away"""
+        if self._flush is not None:
+            self._flush.kill()
+        self.flush()
+
+
+class ObjectRequestCollector(object):
+    """Groups object requests by author and recipient
+
+    Requests are collected for `window` seconds after the first one arrived
+    and then passed to `send` in batches of at most `batch_size` requests
+    with the same author and recipient.
+
+    Args:
+        send (function): Called with author ID, recipient ID and a list of
+            (object type, object id) tuples
+        window (float): Seconds to collect requests for. Requests are sent
+            right away if this is 0.
+        batch_size (int): Maximum number of requests sent together
+    """
+
+    def __init__(self, send, window=1.0, batch_size=100):
+        self.send = send
+        self.window = window
+        self.batch_size = batch_size
+        self.logger = logging.getLogger('synapse')
+        self.logger.setLevel(app.config['LOG_LEVEL'])
+        self._requests = OrderedDict()
+        self._flush = None
+
+    def __len__(self):
+        return sum(len(r) for r in self._requests.itervalues())
+
+    def add(self, author_id, recipient_id, object_type, object_id):
+        """Queue a request for an object
+
+        Args:
+            author_id (String): ID of the Persona sending the request
+            recipient_id (String): ID of the Persona the object is requested from
+            object_type (String): Capitalized class name of the object
+            object_id (String): 32 byte object ID
+        """
+        if self.window <= 0:
+            self.send(author_id, recipient_id, [(object_type, object_id), ])
+            return
+
+        requests = self._requests.setdefault((author_id, recipient_id), OrderedDict())
+        requests[(object_type, object_id)] = True
+
+        if self._flush is None:
+            self._flush = spawn_later(self.window, self.flush)
+
+    def flush(self):
+        """Send all queued requests"""
+        self._flush = None
+        groups = self._requests
+        self._requests = OrderedDict()
+
+        for (author_id, recipient_id), requests in groups.iteritems():
+            requests = requests.keys()
+            self.logger.debug("Sending {} object requests from [{}] to [{}]".format(
+                len(requests), author_id[:6], recipient_id[:6]))
+
+            for i in xrange(0, len(requests), self.batch_size):
+                try:
+                    self.send(author_id, recipient_id, requests[i:i + self.batch_size])
+                except Exception, e:
+                    self.logger.error("Error sending object requests to [{}]: {}".format(recipient_id[:6], e))
+
+    def shutdown(self):
+        """Send queued requests right away"""
+        if self._flush is not None:
+            self._flush.kill()
+        self.flush()
+
+
+class Outbox(object):
+    """Uploads Vesicles to Myelin from a persistent queue
+
+    Vesicles are stored in the outbox_vesicle table when they are added and
+    uploaded by a background greenlet, so adding never waits for Glia. The
+    greenlet is woken up once the added Vesicles have been committed.
+    Vesicles are uploaded together once `max_count` Vesicles or `max_bytes`
+    bytes have been added, or when the first of them has been waiting for
+    `max_age` seconds. Uploads of up to `max_count` Vesicles or `max_bytes`
+    bytes are combined into one request.
+
+    Failed uploads are retried after `retry_delay` seconds, doubling with
+    every attempt up to `max_backoff` and randomized by +-50%, so that many
+    Soumas don't retry at the same time. Vesicles that have not been uploaded
+    when the Souma stops are sent after the next start.
+
+    Args:
+        send (function): Called with a list of (Vesicle id, JSON) tuples.
+            Returns a list of errors if the upload failed.
+        max_count (int): Maximum number of Vesicles sent together
+        max_bytes (int): Maximum size of the Vesicles sent together
+        max_age (float): Seconds a Vesicle may wait for others before it is sent
+        retry_delay (float): Seconds before the first retry of a failed upload
+        max_backoff (float): Maximum seconds between retries
+        poll_interval (float): Seconds after which the outbox is checked for
+            Vesicles that are due for a retry
+    """
+
+    def __init__(self, send, max_count=50, max_bytes=512 * 1024, max_age=0.25,
+            retry_delay=5, max_backoff=3600, poll_interval=30):
+        self.send = send
+        self.max_count = max(1, max_count)
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.retry_delay = retry_delay
+        self.max_backoff = max_backoff
+        self.poll_interval = poll_interval
+        self.logger = logging.getLogger('e-synapse')
+        self.logger.setLevel(app.config['LOG_LEVEL'])
+
+        self._wakeup = Event()
+        self._next_drain = time.time()
+        self._added = 0
+        self._added_bytes = 0
+        self._sender = None
+
+    def __len__(self):
+        return OutboxVesicle.query.count()
+
+    def start(self):
+        """Start the background greenlet uploading queued Vesicles"""
+        if self._sender is None:
+            self._sender = spawn(self._run)
+
+    def add(self, vesicle):
+        """Queue a Vesicle for uploading
+
+        The Vesicle is serialized right away, so later changes to it are not
+        uploaded. Queuing a Vesicle again for the same recipients replaces the
+        earlier version, while copies for other recipients are kept.
+
+        Args:
+            vesicle (Vesicle): The signed Vesicle
+        """
+        data = vesicle.json()
+        recipient_ids = sorted(vesicle.get_keycrypt()) if vesicle.keycrypt else list()
+
+        session = create_session()
+        session.merge(OutboxVesicle(
+            vesicle_id=vesicle.id,
+            recipients=hashlib.sha1(",".join(recipient_ids)).hexdigest(),
+            data=data,
+            queued_at=datetime.datetime.utcnow(),
+            attempts=0,
+            next_attempt=datetime.datetime.utcnow()))
+        commit_session(session)
+
+        # Inside of a batch transaction the Vesicle can't be uploaded before
+        # it has been committed
+        after_commit(lambda: self._queued(len(data)), session=session)
+
+    def _queued(self, size):
+        """Schedule uploading after a Vesicle of size bytes has been queued"""
+        self._added += 1
+        self._added_bytes += size
+
+        if self._added >= self.max_count or self._added_bytes >= self.max_bytes:
+            self._next_drain = time.time()
+        else:
+            self._next_drain = min(self._next_drain, time.time() + self.max_age)
+        self._wakeup.set()
+
+    def _run(self):
+        """Upload queued Vesicles whenever they are due"""
+        while True:
+            delay = self._next_drain - time.time()
+            if delay > 0:
+                self._wakeup.clear()
+                self._wakeup.wait(delay)
+                continue
+
+            try:
+                self.drain()
+            except Exception, e:
+                self.logger.error("Error uploading queued Vesicles: {}".format(e))
+                self._next_drain = time.time() + self.poll_interval
+
+    def _backoff(self, attempts):
+        """Return the randomized number of seconds to wait after a number of failed attempts"""
+        delay = min(self.retry_delay * 2 ** (attempts - 1), self.max_backoff)
+        return delay * random.uniform(0.5, 1.5)
+
+    def drain(self):
+        """Upload all queued Vesicles that are due"""
+        self._added = 0
+        self._added_bytes = 0
+        self._next_drain = time.time() + self.poll_interval
+
+        session = create_session()
+        entries = OutboxVesicle.query \
+            .filter(OutboxVesicle.next_attempt <= datetime.datetime.utcnow()) \
+            .order_by(OutboxVesicle.queued_at).all()
+
+        batches = list()
+        batch_bytes = 0
+        for entry in entries:
+            if not batches or len(batches[-1]) >= self.max_count or \
+                    batch_bytes + len(entry.data) > self.max_bytes:
+                batches.append(list())
+                batch_bytes = 0
+            batches[-1].append((entry.vesicle_id, entry.recipients, entry.queued_at, entry.data, entry.attempts))
+            batch_bytes += len(entry.data)
+
+        if batches:
+            self.logger.debug("Uploading {} queued Vesicles in {} requests".format(len(entries), len(batches)))
+
+        for batch in batches:
+            errors = self.send([(vesicle_id, data) for vesicle_id, recipients, queued_at, data, attempts in batch])
+            now = datetime.datetime.utcnow()
+
+            for vesicle_id, recipients, queued_at, data, attempts in batch:
+                # Vesicles queued again during the upload are kept
+                entry = OutboxVesicle.query.filter_by(
+                    vesicle_id=vesicle_id, recipients=recipients, queued_at=queued_at)
+                if errors:
+                    entry.update({
+                        "attempts": attempts + 1,
+                        "next_attempt": now + datetime.timedelta(seconds=self._backoff(attempts + 1))
+                    })
+                else:
+                    entry.delete()
+            commit_session(session)
+
+            if errors:
+                self.logger.warning("Upload of {} Vesicles failed, will retry".format(len(batch)))
+
+        # Wake up for the earliest retry
+        next_entry = OutboxVesicle.query.order_by(OutboxVesicle.next_attempt).first()
+        if next_entry is not None:
+            next_attempt = time.time() + max(0, (next_entry.next_attempt - datetime.datetime.utcnow()).total_seconds())
+            self._next_drain = min(self._next_drain, next_attempt)
+
+    def shutdown(self):
+        """Stop uploading in the background and try to upload all queued Vesicles right away"""
+        if self._sender is not None:
+            self._sender.kill()
+            self._sender = None
+        self.drain()
@@ -0,0 +1,211 @@
+import logging
+
+from collections import deque
+from contextlib import contextmanager
+from gevent.pool import Pool
+
+from nucleus import batch_transaction, savepoint
+from web_ui import app
+
+
+class ReceivedVesicle(object):
+    """State of a received Vesicle on its way through the handling stages
+
+    Args:
+        data (String or dict): Received Vesicle as passed to Synapse.handle_vesicle
+    """
+
+    def __init__(self, data):
+        self.data = data
+        self.vesicle_id = None
+        self.msg = None
+        self.vesicle = None
+        self.stored = False
+        self.reader_persona = None
+        self.signature_check = None  # (author ID, public signing key, payload, signature)
+        self.decryption = None  # (reader ID, private encryption key, wrapped key, payload, compressed)
+        self.hashcode = None
+        self.plaintext = None
+        self.deferred = False
+        self.reapply = False
+        self.duplicate_of = None
+        self.result = None
+        self.done = False
+        self.failed = False
+
+    def finish(self, result):
+        """Skip all remaining stages and return result as the handling result"""
+        self.result = result
+        self.done = True
+
+    def fail(self):
+        """Skip all remaining stages after an error, so the Vesicle may be handled again later"""
+        self.failed = True
+        self.finish(None)
+
+
+class InboundPipeline(object):
+    """Handles batches of received Vesicles in overlapping stages
+
+    Every Vesicle passes through the parse, crypto, lookup and apply stages
+    of the Synapse (see Synapse.handle_vesicle). Signature verification and
+    decryption of up to `workers` Vesicles run concurrently, while the other
+    stages run in the calling greenlet, which owns the database session.
+    Vesicles are applied in the order they were received, so updates to the
+    same object can't overtake each other. No more than `max_pending`
+    Vesicles are parsed ahead of the one being applied.
+
+    Errors while handling a Vesicle are logged and only discard that Vesicle,
+    which is marked as failed. Inside of a batch transaction its database
+    changes are rolled back to a savepoint (see nucleus.batch_transaction).
+
+    Batch transactions never include waiting for the crypto stage or Glia:
+    the pipeline finishes the crypto and lookup stages of all pending
+    Vesicles first and then applies them in one transaction. A batch is only
+    split if `max_pending` Vesicles are waiting or a Vesicle has to be parsed
+    again after its predecessors have been applied.
+
+    Args:
+        synapse (Synapse): Synapse providing the stage methods
+        workers (int): Number of Vesicles in the crypto stage at once
+        max_pending (int): Maximum number of parsed Vesicles waiting to be applied
+    """
+
+    def __init__(self, synapse, workers=4, max_pending=32):
+        self.synapse = synapse
+        self.workers = workers
+        self.max_pending = max(1, max_pending)
+        self.logger = logging.getLogger('synapse')
+        self.logger.setLevel(app.config['LOG_LEVEL'])
+
+    def _run_stage(self, stage, item, **kwargs):
+        """Run a database stage for item, discarding item if the stage fails"""
+        try:
+            with savepoint():
+                stage(item, **kwargs)
+        except Exception, e:
+            self.logger.error("Error handling received Vesicle: {}".format(e))
+            item.fail()
+
+    def _run_crypto(self, item):
+        """Run the crypto stage for item, discarding item if the stage fails"""
+        try:
+            self.synapse._crypto_stage(item)
+        except Exception, e:
+            self.logger.error("Error verifying or decrypting received Vesicle: {}".format(e))
+            item.fail()
+
+    @contextmanager
+    def _transaction(self, batch):
+        """Run the block in a batch transaction if batch is True"""
+        if batch:
+            with batch_transaction():
+                yield
+        else:
+            yield
+
+    def process(self, messages, batch=False, checkpoint=None):
+        """Handle received Vesicles and return their handling results
+
+        Args:
+            messages (list): JSON encoded Vesicles or the dictionaries they decode to
+            batch (Boolean): Apply the Vesicles in as few transactions as possible
+            checkpoint (function): (Optional) Called with the list of
+                ReceivedVesicles applied together, in order, before their
+                changes are committed
+
+        Returns:
+            list: Result of Synapse.handle_vesicle for each message, in order
+        """
+        pool = Pool(self.workers)
+        pending = deque()
+        results = list()
+        seen = dict()
+
+        def apply_next():
+            """Apply the next Vesicle and all following ones whose crypto stage has finished
+
+            In a batch all pending Vesicles are applied together.
+            """
+            for item, crypto in (pending if batch else [pending[0], ]):
+                if crypto is not None:
+                    crypto.join()
+
+            run = list()
+            while pending and (pending[0][1] is None or pending[0][1].ready()):
+                run.append(pending.popleft()[0])
+
+            for item in run:
+                if not item.done and item.duplicate_of is None:
+                    self._run_stage(self.synapse._lookup_stage, item)
+
+            with self._transaction(batch):
+                for item in run:
+                    if item.duplicate_of is not None:
+                        item.result = item.duplicate_of.result
+                        item.failed = item.duplicate_of.failed
+                    elif not item.done:
+                        self._run_stage(self.synapse._apply_stage, item)
+                    results.append(item.result)
+
+                if checkpoint is not None:
+                    checkpoint(run)
+
+        for data in messages:
+            item = ReceivedVesicle(data)
+            self._run_stage(self.synapse._parse_stage, item, seen=seen, defer_unknown=len(pending) > 0)
+
+            # Applying a Vesicle can make its successors readable, e.g. by
+            # inserting their author. Deferred Vesicles are parsed again once
+            # all preceding Vesicles have been applied.
+            if item.deferred:
+                while pending:
+                    apply_next()
+                item.deferred = False
+                self._run_stage(self.synapse._parse_stage, item, seen=seen)
+
+            crypto = None
+            if not item.done:
+                crypto = pool.spawn(self._run_crypto, item)
+            pending.append((item, crypto))
+
+            while len(pending) >= self.max_pending:
+                apply_next()
+
+        while pending:
+            apply_next()
+
+        self.logger.debug("Handled {} received Vesicles".format(len(results)))
+        return results
+
+    def reapply(self, vesicles):
+        """Apply stored Vesicles again, e.g. after objects they refer to have arrived
+
+        The Vesicles are decrypted in the crypto stage and applied in the
+        order given. Parse and lookup stages and the signature check are
+        skipped, as they already passed when the Vesicles were received.
+
+        Args:
+            vesicles (list): Stored Vesicles that have been handled before
+
+        Returns:
+            list: The ReceivedVesicle of each Vesicle, in order
+        """
+        pool = Pool(self.workers)
+        items = list()
+        for vesicle in vesicles:
+            item = ReceivedVesicle(None)
+            item.vesicle_id = vesicle.id
+            item.vesicle = vesicle
+            item.stored = True
+            item.reapply = True
+            self._run_stage(self.synapse._collect_decryption, item)
+            if not item.done:
+                pool.spawn(self._run_crypto, item)
+            items.append(item)
+        pool.join()
+
+        for item in items:
+            if not item.done:
+                self._run_stage(self.synapse._apply_stage, item)
+        return items
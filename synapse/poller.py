@@ -0,0 +1,117 @@
+import logging
+import time
+
+from web_ui import app
+
+
+class MyelinPoller(object):
+    """Polls the Myelin of all logged in Personas through the Scheduler
+
+    Every Persona has its own polling interval. It starts at `interval` and
+    is multiplied by `backoff` after every poll that returned no Vesicles, up
+    to `max_interval`. Received Vesicles and local activity of a Persona
+    lower its interval to `fast_interval`, so active conversations are polled
+    quickly while idle Personas cause few requests. If Glia holds Myelin
+    requests open until Vesicles arrive (long polling), Personas are polled
+    again right after each response.
+
+    Polls are "myelin" jobs of the scheduler. All Personas that are due
+    within half the fast interval are polled together (see
+    ElectricalSynapse.myelin_receive_many). Adding a Persona that is already
+    polled has no effect, so there is never more than one poller per Persona.
+
+    Args:
+        electrical (ElectricalSynapse): Used for requesting the Myelin
+        scheduler (Scheduler): Runs the polls
+        interval (float): Seconds between the first polls of a Persona
+        max_interval (float): Maximum seconds between two polls of a Persona
+        backoff (float): Factor the interval grows by after an empty poll
+        fast_interval (float): Seconds between two polls of an active
+            Persona. Defaults to `interval`.
+    """
+
+    def __init__(self, electrical, scheduler, interval=10, max_interval=300, backoff=2, fast_interval=None):
+        self.electrical = electrical
+        self.scheduler = scheduler
+        self.interval = interval
+        self.fast_interval = min(interval, fast_interval or interval)
+        self.max_interval = max(interval, max_interval)
+        self.backoff = backoff
+        self.logger = logging.getLogger('e-synapse')
+        self.logger.setLevel(app.config['LOG_LEVEL'])
+
+        self._intervals = dict()
+        self.scheduler.register("myelin", self.poll, coalesce=self.fast_interval / 2.0)
+
+    def __contains__(self, persona_id):
+        return persona_id in self._intervals
+
+    def add(self, persona_id):
+        """Start polling the Myelin of a Persona, beginning right away"""
+        if persona_id in self._intervals:
+            return
+
+        self.logger.debug("Polling Myelin of [{}]".format(persona_id[:6]))
+        self._intervals[persona_id] = self.interval
+        self.scheduler.schedule("myelin", persona_id, 0)
+
+    def remove(self, persona_id):
+        """Stop polling the Myelin of a Persona"""
+        self._intervals.pop(persona_id, None)
+        self.scheduler.cancel("myelin", persona_id)
+
+    def activity(self, persona_id=None):
+        """Switch to the fast polling interval after local activity
+
+        Args:
+            persona_id (String): ID of the active Persona. All Personas are
+                affected if this is None.
+        """
+        persona_ids = self._intervals.keys() if persona_id is None else [persona_id, ]
+        for pid in persona_ids:
+            if pid in self._intervals and self._intervals[pid] > self.fast_interval:
+                self._intervals[pid] = self.fast_interval
+
+                # Polls that are running reschedule themselves with the new interval
+                due = self.scheduler.due("myelin", pid)
+                if due is not None and due > time.time() + self.fast_interval:
+                    self.scheduler.schedule("myelin", pid, self.fast_interval)
+
+    def intervals(self):
+        """Return the current polling interval of every polled Persona ID"""
+        return dict(self._intervals)
+
+    def poll(self, persona_ids):
+        """Poll the Myelin of Personas and schedule their next polls
+
+        Args:
+            persona_ids (list): IDs of the Personas to poll
+        """
+        persona_ids = [pid for pid in persona_ids if pid in self._intervals]
+        now = time.time()
+
+        # Don't poll again right away if polling fails
+        for persona_id in persona_ids:
+            self.scheduler.schedule("myelin", persona_id, self._intervals[persona_id])
+
+        received = self.electrical.myelin_receive_many(persona_ids)
+
+        # Long polling only replaces the interval if Glia has actually waited
+        long_polled = self.electrical.myelin_long_poll and \
+            time.time() - now >= app.config["MYELIN_LONG_POLL_WAIT"] / 2.0
+
+        for persona_id in persona_ids:
+            if persona_id not in self._intervals:
+                continue
+
+            count = received.get(persona_id)
+            if count:
+                interval = self.fast_interval
+            else:
+                interval = min(self._intervals[persona_id] * self.backoff, self.max_interval)
+            self._intervals[persona_id] = interval
+
+            if count is not None and (long_polled or (count and self.electrical.myelin_long_poll)):
+                self.scheduler.schedule("myelin", persona_id, 0)
+            else:
+                self.scheduler.schedule("myelin", persona_id, interval)
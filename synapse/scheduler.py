@@ -0,0 +1,176 @@
+import heapq
+import itertools
+import logging
+import time
+
+from gevent import spawn
+from gevent.event import Event
+
+from web_ui import app
+
+
+class Job(object):
+    """A pending call of a job handler for one key
+
+    Args:
+        kind (String): Kind of the job, selecting its handler
+        key (String): What the job is run for, e.g. a Persona ID
+        due (float): Time at which the job is due
+    """
+
+    def __init__(self, kind, key, due):
+        self.kind = kind
+        self.key = key
+        self.due = due
+        self.cancelled = False
+
+
+class Scheduler(object):
+    """Runs timed jobs of the ElectricalSynapse from a single greenlet
+
+    Jobs are identified by their kind and a key, e.g. "keepalive" and a
+    Persona ID. There is at most one pending job for every kind and key:
+    scheduling a job again replaces the pending one.
+
+    Handlers are registered for every kind of job. Once the first job of a
+    kind is due, all jobs of that kind that are due within the `coalesce`
+    seconds of the kind are passed to its handler together, so they can be
+    served with a single request. Handlers of different kinds run
+    concurrently, but a handler never runs twice at the same time.
+    """
+
+    def __init__(self):
+        self.logger = logging.getLogger('e-synapse')
+        self.logger.setLevel(app.config['LOG_LEVEL'])
+
+        self._handlers = dict()
+        self._heaps = dict()
+        self._jobs = dict()
+        self._running = dict()
+        self._counter = itertools.count()
+        self._wakeup = Event()
+        self._greenlet = None
+
+    def register(self, kind, handler, coalesce=0):
+        """Register the handler for a kind of job
+
+        Args:
+            kind (String): Kind of job
+            handler (function): Called with the list of keys of due jobs
+            coalesce (float): Jobs due within this many seconds of the first
+                due job are run with it
+        """
+        self._handlers[kind] = (handler, coalesce)
+        self._heaps.setdefault(kind, list())
+
+    def schedule(self, kind, key, delay):
+        """Run the handler of kind for key in delay seconds, replacing a pending job
+
+        Args:
+            kind (String): A registered kind of job
+            key (String): What to run the job for
+            delay (float): Seconds until the job is due
+        """
+        if kind not in self._handlers:
+            raise ValueError("No handler registered for {} jobs".format(kind))
+
+        self.cancel(kind, key)
+        job = Job(kind, key, time.time() + max(0, delay))
+        self._jobs[(kind, key)] = job
+        heapq.heappush(self._heaps[kind], (job.due, next(self._counter), job))
+
+        self._wakeup.set()
+        if self._greenlet is None:
+            self._greenlet = spawn(self._run)
+
+    def cancel(self, kind, key):
+        """Cancel the pending job of kind for key
+
+        Returns:
+            Boolean: True if a job was cancelled
+        """
+        job = self._jobs.pop((kind, key), None)
+        if job is None:
+            return False
+        job.cancelled = True
+        return True
+
+    def cancel_all(self, key):
+        """Cancel all pending jobs for key"""
+        for kind in self._handlers:
+            self.cancel(kind, key)
+
+    def due(self, kind, key):
+        """Return the time at which the job of kind for key is due, or None if there is none"""
+        job = self._jobs.get((kind, key))
+        return job.due if job is not None else None
+
+    def jobs(self):
+        """Return all pending jobs, ordered by due time
+
+        Returns:
+            list: Dictionaries with keys `kind`, `key`, `due_in` (seconds) and
+                `running` (True if a job of the same kind is running)
+        """
+        now = time.time()
+        return [{
+            "kind": job.kind,
+            "key": job.key,
+            "due_in": round(job.due - now, 1),
+            "running": job.kind in self._running
+        } for job in sorted(self._jobs.itervalues(), key=lambda j: j.due)]
+
+    def _run(self):
+        """Start the handlers of all kinds that have due jobs"""
+        while True:
+            self._wakeup.clear()
+            timeout = None
+            for kind, heap in self._heaps.iteritems():
+                while heap and heap[0][2].cancelled:
+                    heapq.heappop(heap)
+
+                if not heap or kind in self._running:
+                    continue
+
+                delay = heap[0][0] - time.time()
+                if delay <= 0:
+                    self._start(kind)
+                elif timeout is None or delay < timeout:
+                    timeout = delay
+
+            self._wakeup.wait(timeout)
+
+    def _start(self, kind):
+        """Take all due jobs of kind from the queue and pass them to its handler in a new greenlet"""
+        handler, coalesce = self._handlers[kind]
+        heap = self._heaps[kind]
+        limit = time.time() + coalesce
+
+        keys = list()
+        while heap and heap[0][0] <= limit:
+            job = heapq.heappop(heap)[2]
+            if not job.cancelled:
+                del self._jobs[(kind, job.key)]
+                job.cancelled = True
+                keys.append(job.key)
+
+        if keys:
+            self._running[kind] = spawn(self._call, kind, handler, keys)
+
+    def _call(self, kind, handler, keys):
+        """Call handler with keys and wake up the scheduler when done"""
+        try:
+            handler(keys)
+        except Exception, e:
+            self.logger.error("Error running {} {} jobs: {}".format(len(keys), kind, e))
+        finally:
+            del self._running[kind]
+            self._wakeup.set()
+
+    def shutdown(self):
+        """Stop running jobs"""
+        if self._greenlet is not None:
+            self._greenlet.kill()
+            self._greenlet = None
+        for greenlet in self._running.values():
+            greenlet.kill()
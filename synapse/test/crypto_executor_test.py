@@ -0,0 +1,64 @@
+"""
+Run crypto operations in worker threads of a monkey patched process, like run.py does
+
+Run with `python synapse/test/crypto_executor_test.py`
+"""
+from gevent import monkey
+monkey.patch_all()
+
+import gevent
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+
+from web_ui import app
+
+from keyczar.keys import RsaPrivateKey
+from nucleus.crypto import CryptoExecutor
+
+
+class CryptoExecutorTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.executor = CryptoExecutor(workers=2)
+        cls.key = cls.executor.apply(RsaPrivateKey.Generate, 1024)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.executor.shutdown()
+
+    def test_concurrent_decrypts(self):
+        ciphertext = self.key.Encrypt("message")
+        greenlets = [gevent.spawn(self.executor.apply, self.key.Decrypt, ciphertext) for i in xrange(40)]
+        gevent.joinall(greenlets)
+
+        self.assertEqual([g.exception for g in greenlets], [None] * 40)
+        self.assertEqual([g.value for g in greenlets], ["message"] * 40)
+
+    def test_concurrent_encrypts(self):
+        greenlets = [gevent.spawn(self.executor.map, self.key.Encrypt, ["a", "b"]) for i in xrange(20)]
+        gevent.joinall(greenlets)
+
+        for g in greenlets:
+            self.assertIsNone(g.exception)
+            self.assertEqual([self.key.Decrypt(c) for c in g.value], ["a", "b"])
+
+    def test_apply_raises(self):
+        def fail():
+            raise ValueError("failed")
+
+        self.assertRaises(ValueError, self.executor.apply, fail)
+
+    def test_map_raises(self):
+        def fail_on_b(item):
+            if item == "b":
+                raise ValueError("failed")
+            return item
+
+        self.assertRaises(ValueError, self.executor.map, fail_on_b, ["a", "b", "c"])
+
+if __name__ == '__main__':
+    unittest.main()
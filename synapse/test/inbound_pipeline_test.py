@@ -0,0 +1,156 @@
+"""
+Handle batches of received Vesicles that contain corrupt Vesicles
+
+Run with `python synapse/test/inbound_pipeline_test.py`
+"""
+import datetime
+import json
+import os
+import sys
+import tempfile
+import unittest
+
+from uuid import uuid4
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+
+from web_ui import app
+app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite://"
+app.config["SOUMA_ID"] = uuid4().hex
+app.config["ENABLE_MYELIN"] = False
+app.config["SECRET_KEY"] = uuid4().hex
+app.config["KEYPAIR_POOL_FILE"] = os.path.join(tempfile.mkdtemp(), "keypool.dat")
+
+import synapse
+
+from nucleus import controlled_personas
+from nucleus.models import Persona, Star
+from nucleus.vesicle import Vesicle
+from web_ui import db
+
+
+class FakeElectrical(object):
+    """Stands in for the ElectricalSynapse of a Synapse, without contacting a server"""
+
+    def __init__(self, parent=None):
+        pass
+
+    def persona_info(self, persona_id):
+        return None, ["Glia is offline"]
+
+    def get_persona(self, persona_id):
+        return Persona.query.get(persona_id)
+
+
+def create_persona(name):
+    persona = Persona(id=uuid4().hex, username=name, email="{}@example.com".format(name))
+    persona.generate_keys(None)
+    db.session.add(persona)
+    db.session.commit()
+    return persona
+
+
+class InboundPipelineTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        db.create_all()
+        synapse.ElectricalSynapse = FakeElectrical
+        cls.synapse = synapse.Synapse()
+        cls.reader = create_persona("reader")
+        cls.author = create_persona("author")
+        cls.author_keys = (cls.author.sign_private, cls.author.crypt_private)
+
+    def star_vesicle(self, text):
+        """Return the JSON of an encrypted and signed Vesicle inserting a new Star
+
+        The Vesicle is signed with the author's private key, which is then
+        hidden from the receiving Souma.
+        """
+        self.author.sign_private = self.author_keys[0]
+        self.author.crypt_private = self.author_keys[1]
+        db.session.commit()
+        controlled_personas._ids = None
+
+        now = datetime.datetime.utcnow()
+        star = Star(id=uuid4().hex, text=text, author=self.author, created=now, modified=now)
+        db.session.add(star)
+        db.session.commit()
+        changeset = star.export()
+        db.session.delete(star)
+        db.session.commit()
+
+        vesicle = Vesicle(id=uuid4().hex, message_type="object", author=self.author,
+            data={"action": "insert", "object_type": "Star", "object": changeset})
+        vesicle.author_id = self.author.id
+        vesicle.encrypt(recipients=[self.reader, ])
+        vesicle.sign()
+        message = json.loads(vesicle.json())
+        db.session.rollback()
+
+        self.author.sign_private = ""
+        self.author.crypt_private = ""
+        db.session.commit()
+        controlled_personas._ids = None
+        return message, changeset["id"]
+
+    def corrupt_messages(self):
+        valid = [self.star_vesicle("valid {}".format(i)) for i in xrange(3)]
+
+        bad_signature, bad_signature_star = self.star_vesicle("bad signature")
+        bad_signature["signature"] = "not base64"
+
+        bad_key, bad_key_star = self.star_vesicle("bad key")
+        keycrypt = json.loads(bad_key["keycrypt"])
+        keycrypt[self.reader.id] = "not base64"
+        bad_key["keycrypt"] = json.dumps(keycrypt)
+
+        messages = [valid[0][0], bad_signature, valid[1][0], bad_key, valid[2][0]]
+        return messages, valid, bad_signature_star, bad_key_star
+
+    def check_corrupt_vesicles_are_discarded(self, batch):
+        messages, valid, bad_signature_star, bad_key_star = self.corrupt_messages()
+        results = self.synapse.inbound.process(messages, batch=batch)
+
+        self.assertEqual([r is not None for r in results], [True, False, True, False, True])
+        for message, star_id in valid:
+            self.assertIsNotNone(Star.query.get(star_id))
+        self.assertIsNone(Star.query.get(bad_signature_star))
+        self.assertIsNone(Star.query.get(bad_key_star))
+
+    def test_corrupt_vesicles_are_discarded(self):
+        self.check_corrupt_vesicles_are_discarded(batch=False)
+
+    def test_corrupt_vesicles_are_discarded_in_batch(self):
+        self.check_corrupt_vesicles_are_discarded(batch=True)
+
+    def test_checkpoint_covers_batch(self):
+        messages, valid, bad_signature_star, bad_key_star = self.corrupt_messages()
+        checkpoints = list()
+        self.synapse.inbound.process(messages, batch=True, checkpoint=checkpoints.append)
+
+        # All Vesicles are applied in one transaction
+        self.assertEqual(len(checkpoints), 1)
+        self.assertEqual([item.failed for item in checkpoints[0]], [False, True, False, True, False])
+        self.assertEqual([item.vesicle_id for item in checkpoints[0]], [m["id"] for m in messages])
+
+    def test_reapply_skips_stale_changesets(self):
+        message, star_id = self.star_vesicle("reapplied")
+        vesicle = self.synapse.inbound.process([message])[0]
+        star = Star.query.get(star_id)
+
+        # The stored changeset is as old as the local copy and restores it
+        star.text = "changed"
+        db.session.commit()
+        self.synapse.inbound.reapply([vesicle])
+        self.assertEqual(Star.query.get(star_id).text, "reapplied")
+
+        # The local copy was modified after the stored changeset
+        star.text = "changed"
+        star.modified = datetime.datetime.utcnow() + datetime.timedelta(minutes=1)
+        db.session.commit()
+        self.synapse.inbound.reapply([vesicle])
+        self.assertEqual(Star.query.get(star_id).text, "changed")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,233 @@
+"""
+Count the Myelin requests made for storing Vesicles, using a fake Glia server
+
+Run with `python synapse/test/myelin_store_test.py`
+"""
+import datetime
+import gevent
+import json
+import logging
+import os
+import requests
+import sys
+import unittest
+
+from uuid import uuid4
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+
+from web_ui import app
+app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite://"
+app.config["SOUMA_ID"] = uuid4().hex
+
+from nucleus import batch_transaction, wire
+from nucleus.models import OutboxVesicle
+from nucleus.vesicle import Vesicle
+from synapse.electrical import ElectricalSynapse
+from synapse.outbound import Outbox
+from web_ui import db
+
+
+class FakeResponse(object):
+    def __init__(self, data):
+        self.data = data
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return self.data
+
+
+class FakeGlia(object):
+    """Stands in for the requests session of an ElectricalSynapse and records all requests"""
+
+    def __init__(self):
+        self.requests = list()
+        self.online = True
+
+    def put(self, url, data, headers=None, params=None, verify=None):
+        self.requests.append(("PUT", url, headers["Content-Type"], data))
+        if not self.online:
+            raise requests.exceptions.ConnectionError("Glia is offline")
+        return FakeResponse({"meta": {}})
+
+
+class FakeSouma(object):
+    id = uuid4().hex
+
+    def sign(self, data):
+        return "signature"
+
+
+def fake_electrical(vesicle_format="json", **outbox_args):
+    """Return an ElectricalSynapse connected to a FakeGlia, without contacting a server"""
+    electrical = object.__new__(ElectricalSynapse)
+    electrical.logger = logging.getLogger('e-synapse')
+    electrical.host = "http://glia.test"
+    electrical.souma = FakeSouma()
+    electrical.session = FakeGlia()
+    electrical.rng = open(os.devnull)
+    electrical.vesicle_format = vesicle_format
+    electrical.outbox = Outbox(electrical._myelin_upload, **outbox_args)
+    electrical.outbox.start()
+    return electrical
+
+
+def sample_vesicle(size=100):
+    return Vesicle(id=uuid4().hex, message_type="object", data={"text": "x" * size})
+
+
+def uploaded_ids(request):
+    """Return the IDs of the Vesicles uploaded in a FakeGlia request"""
+    method, url, content_type, data = request
+    return [json.loads(v)["id"] for v in json.loads(data)["vesicles"]]
+
+
+class MyelinStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        db.create_all()
+        OutboxVesicle.query.delete()
+        db.session.commit()
+        self.outboxes = list()
+
+    def tearDown(self):
+        for electrical in self.outboxes:
+            electrical.outbox._sender.kill()
+
+    def electrical(self, *args, **kwargs):
+        electrical = fake_electrical(*args, **kwargs)
+        self.outboxes.append(electrical)
+
+        # Let the outbox finish uploading Vesicles queued before it started
+        gevent.sleep(0.01)
+        return electrical
+
+    def test_store_single(self):
+        electrical = self.electrical()
+        vesicle = sample_vesicle()
+        electrical.myelin_store(vesicle)
+
+        self.assertEqual(len(electrical.session.requests), 1)
+        method, url, content_type, data = electrical.session.requests[0]
+        self.assertTrue(url.endswith("/myelin/vesicles/{}/".format(vesicle.id)))
+        self.assertEqual(len(json.loads(data)["vesicles"]), 1)
+
+    def test_store_single_binary(self):
+        electrical = self.electrical(vesicle_format="binary")
+        vesicle = sample_vesicle()
+        electrical.myelin_store(vesicle)
+
+        method, url, content_type, data = electrical.session.requests[0]
+        self.assertEqual(wire.decode(data)["id"], vesicle.id)
+
+    def test_store_many(self):
+        electrical = self.electrical(vesicle_format="binary")
+        vesicles = [sample_vesicle() for i in xrange(20)]
+        electrical.myelin_store_many(vesicles)
+
+        self.assertEqual(len(electrical.session.requests), 1)
+        method, url, content_type, data = electrical.session.requests[0]
+        self.assertTrue(url.endswith("/myelin/vesicles/"))
+        self.assertEqual(content_type, "application/json")
+        self.assertEqual(uploaded_ids(electrical.session.requests[0]), [v.id for v in vesicles])
+
+    def test_outbox_batches_by_count(self):
+        electrical = self.electrical(max_count=10, max_age=60)
+        vesicles = [sample_vesicle() for i in xrange(25)]
+        for v in vesicles:
+            electrical.myelin_enqueue(v)
+
+        self.assertEqual(len(electrical.session.requests), 0)
+        self.assertEqual(len(electrical.outbox), 25)
+
+        gevent.sleep(0.05)
+        self.assertEqual(len(electrical.session.requests), 3)
+        self.assertEqual(
+            sum([uploaded_ids(r) for r in electrical.session.requests], []),
+            [v.id for v in vesicles])
+        self.assertEqual(len(electrical.outbox), 0)
+
+    def test_outbox_batches_by_size(self):
+        electrical = self.electrical(max_count=100, max_bytes=5000, max_age=60)
+        for i in xrange(10):
+            electrical.myelin_enqueue(sample_vesicle(size=1000))
+
+        gevent.sleep(0.05)
+        self.assertEqual([len(uploaded_ids(r)) for r in electrical.session.requests], [4, 4, 2])
+
+    def test_outbox_sends_by_age(self):
+        electrical = self.electrical(max_count=100, max_age=0.05)
+        for i in xrange(10):
+            electrical.myelin_enqueue(sample_vesicle())
+
+        gevent.sleep(0.01)
+        self.assertEqual(len(electrical.session.requests), 0)
+        gevent.sleep(0.1)
+        self.assertEqual(len(electrical.session.requests), 1)
+        self.assertEqual(len(uploaded_ids(electrical.session.requests[0])), 10)
+
+    def test_outbox_retries_after_restart(self):
+        electrical = self.electrical(max_age=0, retry_delay=60)
+        electrical.session.online = False
+        for i in xrange(3):
+            electrical.myelin_enqueue(sample_vesicle())
+
+        gevent.sleep(0.05)
+        self.assertEqual(len(electrical.session.requests), 1)
+        self.assertEqual(len(electrical.outbox), 3)
+        for entry in OutboxVesicle.query:
+            self.assertEqual(entry.attempts, 1)
+            self.assertTrue(entry.next_attempt > datetime.datetime.utcnow() + datetime.timedelta(seconds=29))
+
+        # Restart after the retry delay with Glia online again
+        electrical.outbox._sender.kill()
+        OutboxVesicle.query.update({"next_attempt": datetime.datetime.utcnow()})
+        db.session.commit()
+
+        restarted = self.electrical(max_age=0)
+        gevent.sleep(0.05)
+        self.assertEqual(len(restarted.session.requests), 1)
+        self.assertEqual(len(uploaded_ids(restarted.session.requests[0])), 3)
+        self.assertEqual(len(restarted.outbox), 0)
+
+    def test_outbox_replaces_vesicle(self):
+        electrical = self.electrical(max_age=60)
+        vesicle = sample_vesicle()
+        vesicle.set_keycrypt({"a": "key"})
+        electrical.myelin_enqueue(vesicle)
+        vesicle.set_keycrypt({"a": "new key"})
+        electrical.myelin_enqueue(vesicle)
+        self.assertEqual(len(electrical.outbox), 1)
+
+        electrical.outbox.drain()
+        self.assertEqual(len(electrical.session.requests), 1)
+        self.assertTrue(electrical.session.requests[0][1].endswith("/{}/".format(vesicle.id)))
+
+    def test_outbox_keeps_copies_for_other_recipients(self):
+        electrical = self.electrical(max_age=60)
+        vesicle = sample_vesicle()
+        vesicle.set_keycrypt({"a": "key"})
+        electrical.myelin_enqueue(vesicle)
+        vesicle.set_keycrypt({"b": "key"})
+        electrical.myelin_enqueue(vesicle)
+        self.assertEqual(len(electrical.outbox), 2)
+
+        electrical.outbox.drain()
+        self.assertEqual(len(electrical.session.requests), 1)
+        self.assertEqual(uploaded_ids(electrical.session.requests[0]), [vesicle.id, vesicle.id])
+        self.assertEqual(len(electrical.outbox), 0)
+
+    def test_outbox_waits_for_commit(self):
+        electrical = self.electrical(max_age=0)
+        with batch_transaction():
+            electrical.myelin_enqueue(sample_vesicle())
+            gevent.sleep(0.05)
+            self.assertEqual(len(electrical.session.requests), 0)
+
+        gevent.sleep(0.05)
+        self.assertEqual(len(electrical.session.requests), 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,91 @@
+"""
+Compare size and speed of the JSON and binary Vesicle encodings
+
+Run with `python synapse/test/wire_benchmark.py`
+"""
+import datetime
+import json
+import os
+import sys
+import timeit
+
+from base64 import b64encode
+from uuid import uuid4
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+
+from web_ui import app  # Import before nucleus to avoid a circular import
+from nucleus import wire
+
+ITERATIONS = 2000
+
+# Payload bytes and number of recipients of the benchmarked Vesicles
+SCENARIOS = [
+    ("small star, 1 recipient", 300, 1),
+    ("small star, 20 recipients", 300, 20),
+    ("long text, 5 recipients", 20000, 5),
+    ("starmap index, 100 recipients", 4000, 100)
+]
+
+# KeyCzar header plus a 4096 bit RSA ciphertext or signature
+RSA_BYTES = 5 + 512
+
+
+def sample_message(payload_size, recipient_count):
+    """Return a Vesicle message as created by Vesicle.message() with random contents"""
+    keycrypt = dict()
+    for i in xrange(recipient_count):
+        keycrypt[uuid4().hex] = b64encode(os.urandom(RSA_BYTES))
+
+    return {
+        "id": uuid4().hex,
+        "message_type": "change_notification",
+        "enc": "0.1-AES-256-zlib",
+        "author_id": uuid4().hex,
+        "souma_id": uuid4().hex,
+        "created": datetime.datetime.utcnow().isoformat(),
+        "payload": b64encode(os.urandom(payload_size)),
+        "signature": b64encode(os.urandom(RSA_BYTES)),
+        "keycrypt": json.dumps(keycrypt)
+    }
+
+
+def myelin_json(message):
+    """Return the Myelin upload body for message in JSON encoding"""
+    return json.dumps({"vesicles": [json.dumps(message), ]})
+
+
+def myelin_binary(message):
+    """Return the Myelin upload body for message in binary encoding"""
+    return wire.encode(message)
+
+
+def run():
+    print "{:<32} {:>9} {:>9} {:>9} {:>9} {:>9} {:>9}".format(
+        "", "json B", "binary B", "upload B", "upload B", "encode", "decode")
+    print "{:<32} {:>9} {:>9} {:>9} {:>9} {:>9} {:>9}".format(
+        "", "", "", "json", "binary", "speedup", "speedup")
+
+    for name, payload_size, recipient_count in SCENARIOS:
+        message = sample_message(payload_size, recipient_count)
+        encoded_json = json.dumps(message)
+        encoded_binary = wire.encode(message)
+        assert wire.decode(encoded_binary) == message
+
+        t_encode_json = timeit.timeit(lambda: json.dumps(message), number=ITERATIONS)
+        t_encode_binary = timeit.timeit(lambda: wire.encode(message), number=ITERATIONS)
+        t_decode_json = timeit.timeit(lambda: json.loads(encoded_json), number=ITERATIONS)
+        t_decode_binary = timeit.timeit(lambda: wire.decode(encoded_binary), number=ITERATIONS)
+
+        print "{:<32} {:>9} {:>9} {:>9} {:>9} {:>8.2f}x {:>8.2f}x".format(
+            name,
+            len(encoded_json),
+            len(encoded_binary),
+            len(myelin_json(message)),
+            len(myelin_binary(message)),
+            t_encode_json / t_encode_binary,
+            t_decode_json / t_decode_binary)
+
+
+if __name__ == "__main__":
+    run()
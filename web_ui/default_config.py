@@ -61,6 +61,37 @@ LAYOUT_DEFINITIONS = dict()
 
 LESS_FILENAMES = ["main"]
 
+#
+# --------------------- NUCLEUS OPTIONS -------------------
+#
+
+# Maximum number of parsed RSA keys kept in memory
+KEY_CACHE_SIZE = 256
+
+# Maximum number of successfully verified Vesicle signatures kept in memory
+VERIFICATION_CACHE_SIZE = 4096
+
+# Maximum number and lifetime in seconds of Vesicle content keys kept in
+# memory for sending already encrypted Vesicles to new recipients
+CONTENT_KEY_CACHE_SIZE = 256
+CONTENT_KEY_CACHE_TTL = 600
+
+# Compress Vesicle payloads of at least VESICLE_COMPRESSION_MIN_SIZE bytes
+# before encrypting them. Compressed Vesicles can only be read by Soumas that
+# support the "0.1-AES-256-zlib" encoding.
+VESICLE_COMPRESSION = True
+VESICLE_COMPRESSION_MIN_SIZE = 256
+
+# Number of threads running RSA and AES operations outside of the gevent loop.
+# Set to 0 to run them synchronously.
+CRYPTO_WORKERS = 2
+
+# Number of RSA keys generated in advance for creating Personas, Groups and
+# Soumas. Set to 0 to generate all keys on demand. The pool file is encrypted
+# with SECRET_KEY, which is stored next to it, so it is only obfuscated.
+KEYPAIR_POOL_SIZE = 4
+KEYPAIR_POOL_FILE = os.path.join(USER_DATA, "keypool_{}.dat".format(LOCAL_PORT))
+
 #
 # --------------------- SYNAPSE OPTIONS -------------------
 #
@@ -75,10 +106,110 @@ SYNAPSE_PORT = LOCAL_PORT + 2000
 LOGIN_SERVER = "glia.herokuapp.com"
 LOGIN_SERVER_SSL = True
 
+# Number of Personas logged in or sent keepalives at the same time
+LOGIN_WORKERS = 4
+
+# Keepalives of Glia sessions that are due within this many seconds of each
+# other are sent together
+KEEPALIVE_COALESCE = 60
+
+# Seconds after which a failed keepalive is retried
+KEEPALIVE_RETRY_DELAY = 30
+
+# Seconds between updates of the peer list of a logged in Persona. Updates
+# due within PEER_LIST_COALESCE seconds of each other use a single request.
+PEER_LIST_INTERVAL = 300
+PEER_LIST_COALESCE = 30
+
 # Setting this to True will automatically upload all vesicles to Myelin, and
 # enable periodic polling of the Myelin for new Vesicles sent to one of the
 # Personas controlled by this Souma
 ENABLE_MYELIN = True
 
-# The interval in seconds at which the Myelin will be polled for new Vesicles
+# The interval in seconds at which the Myelin of a Persona is polled after
+# logging in, and the shorter interval used after it received Vesicles or was
+# used locally. Every poll that returns no Vesicles multiplies the interval
+# by MYELIN_POLLING_BACKOFF, up to MYELIN_POLLING_MAX_INTERVAL.
 MYELIN_POLLING_INTERVAL = 10
+MYELIN_POLLING_FAST_INTERVAL = 3
+MYELIN_POLLING_MAX_INTERVAL = 300
+MYELIN_POLLING_BACKOFF = 2
+
+# Seconds Glia may hold a Myelin request open until Vesicles arrive, if the
+# server supports it. Set to 0 to disable long polling.
+MYELIN_LONG_POLL_WAIT = 25
+
+# Number of Personas whose Myelin is requested at the same time if Glia can't
+# send the Myelin of many Personas in one response
+MYELIN_POLL_WORKERS = 4
+
+# Transfer Vesicles to and from Myelin in the compact binary encoding if the
+# Glia server supports it
+MYELIN_BINARY_VESICLES = True
+
+# Vesicles stored in Myelin are queued in an outbox and uploaded together
+# once this many Vesicles or bytes have been collected, or the oldest queued
+# Vesicle is this many seconds old
+MYELIN_STORE_BATCH_COUNT = 50
+MYELIN_STORE_BATCH_BYTES = 512 * 1024
+MYELIN_STORE_BATCH_AGE = 0.25
+
+# Seconds before a failed Myelin upload is retried. The delay doubles with
+# every failed attempt up to MYELIN_OUTBOX_MAX_BACKOFF. The outbox is checked
+# for Vesicles due for a retry every MYELIN_OUTBOX_POLL_INTERVAL seconds.
+MYELIN_OUTBOX_RETRY_DELAY = 5
+MYELIN_OUTBOX_MAX_BACKOFF = 3600
+MYELIN_OUTBOX_POLL_INTERVAL = 30
+
+# Seconds during which local changes are collected before sending them.
+# Successive changes to the same object are sent as a single Vesicle.
+OUTBOUND_COALESCE_WINDOW = 0.5
+
+# Seconds during which object requests are collected before sending them, and
+# the maximum number of objects requested from a Persona in one Vesicle
+OBJECT_REQUEST_WINDOW = 1.0
+OBJECT_REQUEST_BATCH_SIZE = 100
+
+# Answer object requests with a "snapshot" of the object's current state or
+# by re-sending its complete "history" of Vesicles. Snapshots are only
+# possible for objects authored by a Persona controlled by this Souma, others
+# are always answered with their history.
+OBJECT_REQUEST_REPLY = "snapshot"
+
+# Seconds after which an unanswered object request may be repeated. The
+# timeout doubles with every attempt up to OBJECT_REQUEST_MAX_BACKOFF, and
+# objects are given up on after OBJECT_REQUEST_MAX_ATTEMPTS requests.
+# Pending requests are checked every PENDING_OBJECT_RETRY_INTERVAL seconds.
+OBJECT_REQUEST_TTL = 60
+OBJECT_REQUEST_MAX_BACKOFF = 3600
+OBJECT_REQUEST_MAX_ATTEMPTS = 10
+PENDING_OBJECT_RETRY_INTERVAL = 60
+
+# Ask peers to include the authors, parent Stars and other direct
+# dependencies of requested objects in their reply
+OBJECT_REQUEST_DEPENDENCIES = True
+
+# Apply the Vesicles of a Myelin response in a single database transaction
+# together with the new Myelin offset, with a savepoint for every Vesicle.
+# Signatures are verified and unknown Personas are loaded from Glia before
+# the transaction starts.
+MYELIN_BATCH_TRANSACTIONS = True
+
+# Number of times handling a Vesicle received from Myelin may fail before it
+# is skipped. Until then the Myelin offset stays before the failed Vesicle.
+MYELIN_VESICLE_MAX_ATTEMPTS = 3
+
+# Number of received Vesicles whose signatures are verified and payloads are
+# decrypted at the same time, and the number of Vesicles that may wait for
+# being applied before receiving pauses.
+INBOUND_VESICLE_WORKERS = 4
+INBOUND_VESICLE_QUEUE = 32
+
+# Number of handled Vesicles the duplicate filter is sized for. Received
+# Vesicles that were already handled are dropped before verifying them.
+VESICLE_FILTER_CAPACITY = 100000
+VESICLE_FILTER_ERROR_RATE = 0.001
+
+# What to do with received Vesicles that none of the controlled Personas can
+# decrypt: "drop" them or "store" them without verifying their signature
+UNADDRESSED_VESICLE_POLICY = "drop"
@@ -39,7 +39,7 @@ def reset_userdata():
     """Reset all userdata files"""
     from web_ui import app
 
-    for fileid in ["DATABASE", "SECRET_KEY_FILE", "PASSWORD_HASH_FILE"]:
+    for fileid in ["DATABASE", "SECRET_KEY_FILE", "PASSWORD_HASH_FILE", "KEYPAIR_POOL_FILE"]:
         try:
             os.remove(app.config[fileid])
         except OSError:
@@ -9,6 +9,7 @@ from web_ui import pagemanager
 from web_ui.forms import *
 from web_ui.helpers import get_active_persona, find_links
 from nucleus import notification_signals, PersonaNotFoundError
+from nucleus.crypto import content_key_cache, key_cache, verification_cache
 from nucleus.models import Persona, Group
 from nucleus.models import Star, Planet, PlanetAssociation, LinkPlanet, Starmap, LinkedPicturePlanet, TextPlanet
 
@@ -478,6 +479,11 @@ def debug():
     planets = Planet.query.all()
     groups = Group.query.all()
     starmaps = Starmap.query.all()
+    caches = {
+        "Parsed keys": key_cache.stats(),
+        "Verified signatures": verification_cache.stats(),
+        "Content keys": content_key_cache.stats(),
+    }
 
     return render_template(
         'debug.html',
@@ -485,10 +491,28 @@ def debug():
         personas=personas,
         planets=planets,
         groups=groups,
-        starmaps=starmaps
+        starmaps=starmaps,
+        caches=caches,
+        jobs=scheduled_jobs()
     )
 
 
+def scheduled_jobs():
+    """Return the pending jobs of the running ElectricalSynapse, if there is one"""
+    from synapse.electrical import ElectricalSynapse
+
+    electrical = ElectricalSynapse._instance
+    if electrical is None or not hasattr(electrical, "scheduler"):
+        return list()
+    return electrical.scheduler.jobs()
+
+
+@app.route('/debug/scheduler')
+def debug_scheduler():
+    """ Return the pending keepalive, peer list and Myelin jobs as JSON """
+    return json_response({"jobs": scheduled_jobs()})
+
+
 @app.route('/find-people', methods=['GET', 'POST'])
 def find_people():
     """Search for and follow people"""